@@ -0,0 +1,10 @@
+from api.cache.client import get_redis_client
+from api.cache.conversation import (
+	ConversationMessageCache, CachedMessage, message_key, parse_message_key)
+from api.cache.unreads import UnreadCounters
+from api.cache.receipts import ReadReceiptBuffer
+from api.cache.members import ConversationMembersCache
+from api.cache.events import ConversationEventStream
+from api.cache.presence import UserPresence
+from api.cache.typing import TypingIndicators
+from api.cache.users import AuthenticatedUserCache
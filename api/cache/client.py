@@ -0,0 +1,14 @@
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+
+
+@lru_cache(maxsize= None)
+def get_redis_client() -> redis.Redis:
+	"""
+	Returns a process-wide client for the Redis instance backing the cache.
+	Used where we need Redis data structures rather than plain key/value pairs.
+	"""
+
+	return redis.Redis.from_url(settings.REDIS_CACHE_URL)
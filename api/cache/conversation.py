@@ -0,0 +1,431 @@
+import sys
+import uuid
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import NamedTuple
+
+import msgpack
+from django.conf import settings
+from rest_framework.fields import DateTimeField
+
+from api.cache.client import get_redis_client
+from api.cache.local import LocalLRUCache
+from api.metrics import metrics
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo= timezone.utc)
+
+# Layout of the cached message records. The sender summary mirrors UserRetrieveSerializer.
+MESSAGE_FIELDS = (
+	"id", "conversation", "message_type", "media_url", "text",
+	"sent_at", "updated_at", "deleted_at", "sent_by",
+)
+SENDER_FIELDS = ("id", "email", "first_name", "last_name", "is_active")
+
+datetime_field = DateTimeField()
+
+# Every script takes the window keys in the order index, entries, meta, build.
+# The build key holds the token of the one rebuild allowed to run at a time. Writes
+# against a missing window drop it so that a rebuild which started before the write
+# can't store a snapshot that misses it. Writes to an existing window bump its `seq`,
+# which together with the `epoch` of the rebuild versions the window for the
+# in-process cache.
+
+PUSH_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+	redis.call('DEL', KEYS[4])
+	return 0
+end
+
+local floor = redis.call('HGET', KEYS[3], 'floor')
+if floor ~= '' and ARGV[1] < floor then
+	return 0
+end
+
+redis.call('ZADD', KEYS[1], 0, ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+
+local overflow = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[4])
+if overflow > 0 then
+	local trimmed = redis.call('ZRANGE', KEYS[1], 0, overflow - 1)
+	redis.call('ZREMRANGEBYRANK', KEYS[1], 0, overflow - 1)
+	for _, member in ipairs(trimmed) do
+		redis.call('HDEL', KEYS[2], string.sub(member, 18))
+	end
+	redis.call('HSET', KEYS[3], 'floor', redis.call('ZRANGE', KEYS[1], 0, 0)[1])
+end
+
+redis.call('HINCRBY', KEYS[3], 'seq', 1)
+for i = 1, 3 do
+	redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+return 1
+"""
+
+PATCH_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+	redis.call('DEL', KEYS[4])
+	return 0
+end
+
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+	return 0
+end
+
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('HINCRBY', KEYS[3], 'seq', 1)
+return 1
+"""
+
+REMOVE_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+	redis.call('DEL', KEYS[4])
+	return 0
+end
+
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[2])
+redis.call('HINCRBY', KEYS[3], 'seq', 1)
+return 1
+"""
+
+# ARGV holds a range command on the index (ZREVRANGE, ZRANGEBYLEX...) and its arguments.
+READ_SCRIPT = """
+local meta = redis.call('HMGET', KEYS[3], 'floor', 'epoch', 'seq')
+if not meta[1] then
+	return false
+end
+
+local result = {meta[1], redis.call('ZCARD', KEYS[1]), meta[2] .. ':' .. meta[3]}
+for _, member in ipairs(redis.call(ARGV[1], KEYS[1], unpack(ARGV, 2))) do
+	table.insert(result, member)
+	table.insert(result, redis.call('HGET', KEYS[2], string.sub(member, 18)) or '')
+end
+return result
+"""
+
+ABORT_SCRIPT = """
+if redis.call('GET', KEYS[4]) == ARGV[1] then
+	redis.call('DEL', KEYS[4])
+end
+return 1
+"""
+
+COMMIT_SCRIPT = """
+if redis.call('GET', KEYS[4]) ~= ARGV[1] then
+	return 0
+end
+
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+redis.call('HSET', KEYS[3], 'floor', ARGV[3], 'epoch', ARGV[1], 'seq', 0)
+
+for i = 4, #ARGV, 2 do
+	redis.call('ZADD', KEYS[1], 0, ARGV[i])
+	redis.call('HSET', KEYS[2], string.sub(ARGV[i], 18), ARGV[i + 1])
+end
+
+for i = 1, 3 do
+	redis.call('EXPIRE', KEYS[i], ARGV[2])
+end
+return 1
+"""
+
+
+# Windows held by this process keep the raw payloads of their messages, decoded a page
+# at a time, so that what they are charged is what they take.
+local_cache = LocalLRUCache(settings.MESSAGE_CACHE_LOCAL_MAX_BYTES)
+
+# Memory taken by a message of a local window besides its key and payload: the empty
+# str and bytes objects and their slots in the two lists.
+LOCAL_ENTRY_OVERHEAD = sys.getsizeof("") + sys.getsizeof(b"") + 2 * 8
+
+
+@lru_cache(maxsize= None)
+def get_script(source):
+	return get_redis_client().register_script(source)
+
+
+def message_key(sent_at: datetime, message_id) -> str:
+	"""
+	Returns the sorted set member of a message. Members are zero padded microseconds
+	since epoch followed by the message id, so they sort by (sent_at, id).
+	"""
+
+	micros = (sent_at - EPOCH) // timedelta(microseconds= 1)
+	return f"{micros:016d}:{message_id}"
+
+
+def parse_message_key(key: str):
+	""" Returns the (sent_at, id) pair a sorted set member was built from. """
+
+	micros, message_id = key.split(":", 1)
+	return EPOCH + timedelta(microseconds= int(micros)), uuid.UUID(message_id)
+
+
+def message_record(message) -> list:
+	"""
+	Returns the compact, already serialized form of a message kept in the cache.
+	Fields follow MESSAGE_FIELDS and render the way SimpleMessageSerializer does,
+	`is_mine` and `seen_by` excepted as they depend on the reader.
+	"""
+
+	sender = message.sent_by
+	deleted = message.deleted_at is not None
+
+	return [
+		str(message.id),
+		str(message.conversation_id),
+		message.message_type,
+		"" if deleted else message.media_url,
+		"" if deleted else message.text,
+		datetime_field.to_representation(message.sent_at),
+		message.updated_at and datetime_field.to_representation(message.updated_at),
+		message.deleted_at and datetime_field.to_representation(message.deleted_at),
+		sender and [getattr(sender, field) for field in SENDER_FIELDS],
+	]
+
+
+def record_to_dict(record) -> dict:
+	data = dict(zip(MESSAGE_FIELDS, record))
+	if data["sent_by"]:
+		data["sent_by"] = dict(zip(SENDER_FIELDS, data["sent_by"]))
+
+	return data
+
+
+class CachedMessage(NamedTuple):
+	""" A message as served from the cache: its window key and its rendered fields. """
+
+	key: str
+	data: dict
+
+	@classmethod
+	def from_message(cls, message):
+		return cls(message_key(message.sent_at, message.id), record_to_dict(message_record(message)))
+
+
+def decode_payload(payload: bytes) -> dict:
+	return record_to_dict(msgpack.unpackb(payload))
+
+
+class LocalWindow(NamedTuple):
+	"""
+	Whole window of a conversation held in the in-process cache, oldest message first,
+	as message keys and raw payloads. Only the messages of the pages read are decoded.
+	"""
+
+	version: str
+	floor: str
+	keys: list
+	payloads: list
+
+	def size(self) -> int:
+		return sum(
+			len(key) + len(payload) + LOCAL_ENTRY_OVERHEAD for key, payload in zip(self.keys, self.payloads))
+
+	def messages(self, start, stop) -> list:
+		""" Messages `start` to `stop` (excluded), oldest first. """
+
+		return [
+			CachedMessage(key, decode_payload(payload))
+			for key, payload in zip(self.keys[start:stop], self.payloads[start:stop])
+		]
+
+	def read(self, start, stop):
+		count = len(self.keys)
+		end = count - start
+		begin = 0 if stop == -1 else max(0, count - stop - 1)
+		return self.floor, count, self.messages(begin, max(begin, end))[::-1]
+
+	def read_before(self, key, limit):
+		end = bisect_left(self.keys, key) if key else len(self.keys)
+		return self.floor, len(self.keys), self.messages(max(0, end - limit), end)[::-1]
+
+	def read_after(self, key, limit):
+		start = bisect_right(self.keys, key)
+		return self.floor, len(self.keys), self.messages(start, start + limit)
+
+
+class ConversationMessageCache:
+	"""
+	Window over the most recent messages of a conversation, kept in Redis.
+
+	Messages are indexed in a sorted set ordered by (sent_at, id) while their payloads
+	live in a hash keyed by message id, so a single message can be pushed, patched or
+	removed without rewriting the window. The meta hash holds the `floor`: the oldest
+	message kept once the window has been trimmed, or an empty string when the window
+	holds the whole conversation.
+	"""
+
+	def __init__(self, conversation_id, size= None, timeout= 60*60*24):
+		self.conversation_id = conversation_id
+		self.size = size or settings.MESSAGE_CACHE_SIZE
+		self.timeout = timeout
+
+		prefix = f"messages:conversation:{conversation_id}"
+		self.keys = [f"{prefix}:index", f"{prefix}:entries", f"{prefix}:meta", f"{prefix}:build"]
+
+	def encode(self, message) -> bytes:
+		return msgpack.packb(message_record(message))
+
+	def decode(self, payload: bytes) -> dict:
+		return decode_payload(payload)
+
+	def push(self, message) -> bool:
+		""" Adds a new message to the window, trimming the oldest ones beyond `size`. """
+
+		return bool(get_script(PUSH_SCRIPT)(
+			keys= self.keys,
+			args= [
+				message_key(message.sent_at, message.id), str(message.id),
+				self.encode(message), self.size, self.timeout
+			]
+		))
+
+	def patch(self, message) -> bool:
+		""" Replaces the payload of a message already in the window. """
+
+		return bool(get_script(PATCH_SCRIPT)(
+			keys= self.keys,
+			args= [message_key(message.sent_at, message.id), str(message.id), self.encode(message)]
+		))
+
+	def remove(self, message) -> bool:
+		return bool(get_script(REMOVE_SCRIPT)(
+			keys= self.keys,
+			args= [message_key(message.sent_at, message.id), str(message.id)]
+		))
+
+	def read(self, start, stop):
+		"""
+		Returns `(floor, window_size, messages)` for the messages ranked `start` to `stop`,
+		newest first, as CachedMessage items. Returns None when the window is missing or
+		corrupt, in which case it has to be rebuilt.
+		"""
+
+		local = self.read_local()
+		if local is not None:
+			return local.read(start, stop)
+
+		return self._read("ZREVRANGE", start, stop)
+
+	def read_before(self, key, limit):
+		""" Same as `read`, for the `limit` messages right before `key` (or the newest ones). """
+
+		local = self.read_local()
+		if local is not None:
+			return local.read_before(key, limit)
+
+		return self._read("ZREVRANGEBYLEX", f"({key}" if key else "+", "-", "LIMIT", 0, limit)
+
+	def read_after(self, key, limit):
+		""" Same as `read`, for the `limit` messages right after `key`, oldest first. """
+
+		local = self.read_local()
+		if local is not None:
+			return local.read_after(key, limit)
+
+		return self._read("ZRANGEBYLEX", f"({key}", "+", "LIMIT", 0, limit)
+
+	def read_local(self):
+		"""
+		Returns the window from the in-process cache once its version has been checked
+		against Redis, loading the whole window on a version change. Returns None when
+		the in-process cache is disabled or the window is missing.
+		"""
+
+		if not local_cache.max_bytes:
+			return None
+
+		epoch, seq = get_redis_client().hmget(self.keys[2], "epoch", "seq")
+		if epoch is None:
+			return None
+
+		local = local_cache.get(self.conversation_id)
+		if local is not None and local.version == f"{epoch.decode()}:{seq.decode()}":
+			metrics.incr("message_cache.local_hit")
+			return local
+
+		metrics.incr("message_cache.local_miss")
+
+		result = self._fetch("ZRANGE", 0, -1)
+		if result is None:
+			return None
+
+		floor, _, version, keys, payloads = result
+		# Corrupt payloads are caught here, before the window is kept.
+		if self._decode(keys, payloads) is None:
+			return None
+
+		local = LocalWindow(version, floor, keys, payloads)
+		local_cache.set(self.conversation_id, local, local.size())
+
+		return local
+
+	def _read(self, command, *args):
+		result = self._fetch(command, *args)
+		if result is None:
+			return None
+
+		floor, window_size, _, keys, payloads = result
+		messages = self._decode(keys, payloads)
+		if messages is None:
+			return None
+
+		return floor, window_size, messages
+
+	def _fetch(self, command, *args):
+		""" Runs the read script, returning `(floor, window_size, version, keys, payloads)`. """
+
+		result = get_script(READ_SCRIPT)(keys= self.keys, args= [command, *args])
+		if result is None:
+			return None
+
+		floor, window_size, version, *entries = result
+		return (
+			floor.decode(), window_size, version.decode(),
+			[key.decode() for key in entries[::2]], entries[1::2]
+		)
+
+	def _decode(self, keys, payloads):
+		""" Messages of the entries read, or None after dropping a corrupt window. """
+
+		try:
+			return [CachedMessage(key, self.decode(payload)) for key, payload in zip(keys, payloads)]
+		except Exception:
+			self.clear()
+			return None
+
+	def begin_rebuild(self):
+		"""
+		Claims the rebuild of a missing window and returns its token, or None when
+		another worker is already rebuilding it. Writes made until the rebuild is
+		committed void it.
+		"""
+
+		token = uuid.uuid4().hex
+		timeout = int(settings.MESSAGE_CACHE_REBUILD_TIMEOUT * 1000)
+
+		if get_redis_client().set(self.keys[3], token, px= timeout, nx= True):
+			return token
+
+		return None
+
+	def abort_rebuild(self, token):
+		get_script(ABORT_SCRIPT)(keys= self.keys, args= [token])
+
+	def commit_rebuild(self, token, messages, floor) -> bool:
+		"""
+		Replaces the window with `messages`, newest first, unless a write reached the
+		conversation since `begin_rebuild`.
+		"""
+
+		args = [token, self.timeout, floor]
+		for message in messages:
+			args += [message_key(message.sent_at, message.id), msgpack.packb(message_record(message))]
+
+		return bool(get_script(COMMIT_SCRIPT)(keys= self.keys, args= args))
+
+	def clear(self):
+		get_redis_client().delete(*self.keys)
@@ -0,0 +1,77 @@
+from django.conf import settings
+
+from api.cache.client import get_redis_client
+from api.cache.conversation import get_script
+
+
+# KEYS are the sequence and the stream of the conversation. The sequence number is
+# spliced into the already encoded frame (a JSON object) and doubles as its stream id,
+# so the stream can be read from any sequence number.
+APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+local frame = '{"conversation": "' .. ARGV[2] .. '", "seq": ' .. seq .. ', ' .. string.sub(ARGV[1], 2)
+
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], seq .. '-0', 'frame', frame)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return frame
+"""
+
+
+class ConversationEventStream:
+	"""
+	Events broadcast to a conversation, numbered by a per-conversation sequence and
+	kept in a Redis stream capped to about EVENT_STREAM_LENGTH events, so that clients
+	coming back can be sent what they missed. The sequence never expires, the stream
+	is dropped after `timeout` without events.
+	"""
+
+	def __init__(self, conversation_id, timeout= 60*60*24):
+		self.conversation_id = conversation_id
+		self.timeout = timeout
+
+		prefix = f"events:conversation:{conversation_id}"
+		self.keys = [f"{prefix}:seq", f"{prefix}:stream"]
+
+	def append(self, frame: str) -> str:
+		""" Numbers an encoded frame and stores it, returns the frame with its `seq`. """
+
+		return get_script(APPEND_SCRIPT)(
+			keys= self.keys,
+			args= [frame, str(self.conversation_id), settings.EVENT_STREAM_LENGTH, self.timeout]
+		).decode()
+
+	def read_after(self, seq: int) -> list[str] | None:
+		"""
+		Frames of the events numbered after `seq`, or None when some of them have been
+		trimmed (or `seq` is unknown) and the client has to reload the conversation.
+		"""
+
+		pipeline = get_redis_client().pipeline()
+		pipeline.get(self.keys[0])
+		pipeline.xrange(self.keys[1], min= f"{seq + 1}-0")
+		current, entries = pipeline.execute()
+
+		current = int(current or 0)
+		if seq == current:
+			return []
+
+		if seq > current or not entries or entries[0][0].decode() != f"{seq + 1}-0":
+			return None
+
+		return [fields[b"frame"].decode() for _, fields in entries]
+
+	@staticmethod
+	def current(conversation_ids) -> dict:
+		""" Latest sequence number of each conversation. """
+
+		conversation_ids = list(conversation_ids)
+		if not conversation_ids:
+			return {}
+
+		seqs = get_redis_client().mget(
+			[f"events:conversation:{conversation_id}:seq" for conversation_id in conversation_ids])
+
+		return {
+			str(conversation_id): int(seq or 0)
+			for conversation_id, seq in zip(conversation_ids, seqs)
+		}
@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+
+class LocalLRUCache:
+	"""
+	Thread-safe in-process LRU cache bounded by the total size of its values.
+	Callers tell the size of each value, entries are evicted least recently used first.
+	"""
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()
+		self.size = 0
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+
+			self.entries.move_to_end(key)
+			return entry[0]
+
+	def set(self, key, value, size):
+		with self.lock:
+			self._pop(key)
+
+			if size > self.max_bytes:
+				return
+
+			self.entries[key] = (value, size)
+			self.size += size
+
+			while self.size > self.max_bytes:
+				self._pop(next(iter(self.entries)))
+
+	def delete(self, key):
+		with self.lock:
+			self._pop(key)
+
+	def delete_matching(self, match):
+		""" Drops every entry whose key `match` returns True for. """
+
+		with self.lock:
+			for key in [key for key in self.entries if match(key)]:
+				self._pop(key)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+
+	def _pop(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.size -= entry[1]
@@ -0,0 +1,53 @@
+from api.cache.client import get_redis_client
+from api.cache.conversation import get_script
+
+
+# Member that keeps the set of a conversation without members from looking missing.
+PRESENT = "_"
+
+UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+	return 0
+end
+
+redis.call(ARGV[1], KEYS[1], unpack(ARGV, 2))
+return 1
+"""
+
+
+class ConversationMembersCache:
+	"""
+	Ids of the members of a conversation, kept in a Redis set so that events can be
+	fanned out to them without a query. Membership changes are applied to sets that
+	exist, missing ones are filled from the database on their next read.
+	"""
+
+	def __init__(self, conversation_id, timeout= 60*60*24):
+		self.conversation_id = conversation_id
+		self.timeout = timeout
+		self.key = f"members:conversation:{conversation_id}"
+
+	def read(self) -> set | None:
+		members = get_redis_client().smembers(self.key)
+		if not members:
+			return None
+
+		return {int(member) for member in members if member.decode() != PRESENT}
+
+	def fill(self, user_ids):
+		pipeline = get_redis_client().pipeline()
+		pipeline.delete(self.key)
+		pipeline.sadd(self.key, PRESENT, *user_ids)
+		pipeline.expire(self.key, self.timeout)
+		pipeline.execute()
+
+	def add(self, user_ids):
+		if user_ids:
+			get_script(UPDATE_SCRIPT)(keys= [self.key], args= ["SADD", *user_ids])
+
+	def remove(self, user_ids):
+		if user_ids:
+			get_script(UPDATE_SCRIPT)(keys= [self.key], args= ["SREM", *user_ids])
+
+	def clear(self):
+		get_redis_client().delete(self.key)
@@ -0,0 +1,121 @@
+import time
+
+from api.cache.client import get_redis_client
+from api.cache.conversation import get_script
+
+
+# Users with live connections, scored by when their last connection expires.
+ONLINE_USERS_KEY = "presence:users"
+
+# KEYS are the connections of the user, scored by when they expire without a heartbeat,
+# and ONLINE_USERS_KEY. Both return the number of live connections, before the
+# connection was added and after it was removed respectively.
+CONNECT_SCRIPT = """
+local now = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+
+local connections = redis.call('ZCARD', KEYS[1])
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[3]), ARGV[4])
+return connections
+"""
+
+DISCONNECT_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+
+local connections = redis.call('ZCARD', KEYS[1])
+if connections == 0 then
+	redis.call('ZREM', KEYS[2], ARGV[3])
+end
+return connections
+"""
+
+# Same KEYS, for a user whose last connection looked expired. Returns 1 when the user
+# has no live connection left, only to the one sweep that takes them offline.
+SWEEP_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+
+local latest = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+if #latest == 0 then
+	return redis.call('ZREM', KEYS[2], ARGV[2])
+end
+
+redis.call('ZADD', KEYS[2], latest[2], ARGV[2])
+return 0
+"""
+
+
+def connections_key(user_id) -> str:
+	return f"presence:user:{user_id}:connections"
+
+
+class UserPresence:
+	"""
+	Live websocket connections of a user, each kept for `timeout` seconds after its last
+	heartbeat so that connections which died without closing go offline on their own.
+	A user is online while one of their connections is.
+	"""
+
+	def __init__(self, user_id):
+		self.user_id = user_id
+
+		prefix = f"presence:user:{user_id}"
+		self.keys = [connections_key(user_id), f"{prefix}:debounce", f"{prefix}:broadcast"]
+
+	def connect(self, channel_name, timeout: int) -> bool:
+		""" Adds or refreshes a connection, returns True when the user came online. """
+
+		return not get_script(CONNECT_SCRIPT)(
+			keys= [self.keys[0], ONLINE_USERS_KEY], args= [channel_name, time.time(), timeout, self.user_id])
+
+	def disconnect(self, channel_name) -> bool:
+		""" Removes a connection, returns True when the user went offline. """
+
+		return not get_script(DISCONNECT_SCRIPT)(
+			keys= [self.keys[0], ONLINE_USERS_KEY], args= [channel_name, time.time(), self.user_id])
+
+	def debounce(self, window: float) -> bool:
+		""" Returns True when this opened a window of `window` seconds for presence changes. """
+
+		if not window:
+			return True
+
+		return bool(get_redis_client().set(self.keys[1], 1, nx= True, px= int(window * 1000)))
+
+	def mark_broadcast(self, online: bool) -> bool:
+		""" Records the state broadcast for the user, returns False when it already was. """
+
+		previous = get_redis_client().getset(self.keys[2], int(online))
+
+		return int(previous or 0) != int(online)
+
+	@staticmethod
+	def sweep(limit: int) -> list:
+		"""
+		Drops the connections which expired without closing, of up to `limit` users, and
+		returns the users that left offline.
+		"""
+
+		now = time.time()
+		user_ids = get_redis_client().zrangebyscore(ONLINE_USERS_KEY, "-inf", now, start= 0, num= limit)
+
+		return [
+			int(user_id) for user_id in user_ids
+			if get_script(SWEEP_SCRIPT)(
+				keys= [connections_key(int(user_id)), ONLINE_USERS_KEY], args= [now, int(user_id)])
+		]
+
+	@staticmethod
+	def online(user_ids) -> dict:
+		""" Whether each user is online, in a single round trip. """
+
+		user_ids = list(user_ids)
+		now = time.time()
+
+		pipeline = get_redis_client().pipeline(transaction= False)
+		for user_id in user_ids:
+			pipeline.zcount(connections_key(user_id), f"({now}", "+inf")
+
+		return {user_id: bool(count) for user_id, count in zip(user_ids, pipeline.execute())}
@@ -0,0 +1,67 @@
+import json
+
+from api.cache.conversation import get_script, message_key
+
+
+# KEYS are the pending receipts and the window of the conversation. Receipts are
+# stored by user as "<message key> <payload>" so that only the latest one is kept.
+# Returns 1 when the caller opened the window and so has to flush it.
+ADD_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current or string.sub(current, 1, #ARGV[2]) < ARGV[2] then
+	redis.call('HSET', KEYS[1], ARGV[1], ARGV[2] .. ' ' .. ARGV[3])
+end
+redis.call('EXPIRE', KEYS[1], 3600)
+
+if tonumber(ARGV[4]) == 0 then
+	return 1
+end
+
+if redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[4]) then
+	return 1
+end
+return 0
+"""
+
+DRAIN_SCRIPT = """
+local receipts = redis.call('HVALS', KEYS[1])
+redis.call('DEL', KEYS[1])
+return receipts
+"""
+
+
+class ReadReceiptBuffer:
+	"""
+	Read receipts of a conversation waiting to be broadcast. Every user appears once,
+	with the latest message they read, so a burst of receipts goes out as one event.
+	"""
+
+	def __init__(self, conversation_id):
+		self.conversation_id = conversation_id
+
+		prefix = f"receipts:conversation:{conversation_id}"
+		self.keys = [f"{prefix}:pending", f"{prefix}:window"]
+
+	def add(self, user_id, message, window: float) -> bool:
+		"""
+		Records that the user read up to `message`. Returns True when this opened a
+		coalescing window of `window` seconds, which the caller has to `drain` once over.
+		"""
+
+		receipt = {"user": user_id, "message": str(message.id), "sent_at": message.sent_at.isoformat()}
+
+		return bool(get_script(ADD_SCRIPT)(
+			keys= self.keys,
+			args= [
+				user_id, message_key(message.sent_at, message.id),
+				json.dumps(receipt), int(window * 1000)
+			]
+		))
+
+	def drain(self) -> list:
+		""" Returns and forgets the pending receipts. """
+
+		return [
+			json.loads(receipt.split(b" ", 1)[1])
+			for receipt in get_script(DRAIN_SCRIPT)(keys= self.keys[:1])
+		]
@@ -0,0 +1,73 @@
+import time
+
+from api.cache.client import get_redis_client
+from api.cache.conversation import get_script
+
+
+# KEYS are the users typing in the conversation, scored by when they stop without a
+# typing.stop, and the broadcast window of the conversation. Only changes to the set of
+# users typing count, a user typing again is just kept longer.
+# Returns 1 when the caller opened the window and so has to broadcast once it is over.
+UPDATE_SCRIPT = """
+local now = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+
+local changed
+if ARGV[3] == '1' then
+	changed = redis.call('ZADD', KEYS[1], now + tonumber(ARGV[4]), ARGV[1])
+	redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[4])))
+else
+	changed = redis.call('ZREM', KEYS[1], ARGV[1])
+end
+
+if changed == 0 then
+	return 0
+end
+
+if tonumber(ARGV[5]) == 0 then
+	return 1
+end
+
+if redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[5]) then
+	return 1
+end
+return 0
+"""
+
+
+class TypingIndicators:
+	"""
+	Users typing in a conversation, each for `timeout` seconds after their last typing
+	frame, so that the conversation is told at most once per broadcast window however
+	many of them type.
+	"""
+
+	def __init__(self, conversation_id, timeout: float):
+		self.conversation_id = conversation_id
+		self.timeout = timeout
+
+		prefix = f"typing:conversation:{conversation_id}"
+		self.keys = [f"{prefix}:users", f"{prefix}:window"]
+
+	def update(self, user_id, typing: bool, window: float) -> bool:
+		"""
+		Records that the user started or stopped typing. Returns True when this opened a
+		window of `window` seconds, which the caller has to broadcast once over.
+		"""
+
+		return bool(get_script(UPDATE_SCRIPT)(
+			keys= self.keys,
+			args= [user_id, time.time(), int(typing), self.timeout, int(window * 1000)]
+		))
+
+	def read(self, limit: int) -> tuple[list, int]:
+		""" First `limit` users typing, and how many are. """
+
+		now = time.time()
+
+		pipeline = get_redis_client().pipeline(transaction= False)
+		pipeline.zrangebyscore(self.keys[0], f"({now}", "+inf", start= 0, num= limit)
+		pipeline.zcount(self.keys[0], f"({now}", "+inf")
+		users, count = pipeline.execute()
+
+		return [int(user) for user in users], count
@@ -0,0 +1,87 @@
+from api.cache.client import get_redis_client
+from api.cache.conversation import get_script
+
+
+# Field that tells a hash holding every count of a user (possibly none) from a hash
+# that doesn't exist. Counters are only ever changed in complete hashes, a missing one
+# is filled from the database on its next read.
+PRESENT = "_"
+
+INCR_SCRIPT = """
+for _, key in ipairs(KEYS) do
+	if redis.call('EXISTS', key) == 1 then
+		redis.call('HINCRBY', key, ARGV[1], ARGV[2])
+	end
+end
+return 1
+"""
+
+SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+	return 0
+end
+
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+
+def unreads_key(user_id) -> str:
+	return f"unreads:user:{user_id}"
+
+
+class UnreadCounters:
+	"""
+	Unread message counts of a user, kept in a Redis hash of conversation id to count.
+	New messages increment them and reading a conversation resets its count, so the
+	counts are read with a single HGETALL. They expire after `timeout`, which bounds
+	any drift from the database.
+	"""
+
+	def __init__(self, user_id, timeout= 60*60*24):
+		self.user_id = user_id
+		self.timeout = timeout
+		self.key = unreads_key(user_id)
+
+	@staticmethod
+	def increment(conversation_id, user_ids, amount= 1):
+		""" Adds `amount` to the count of a conversation for each of the users. """
+
+		keys = [unreads_key(user_id) for user_id in user_ids]
+		if keys:
+			get_script(INCR_SCRIPT)(keys= keys, args= [str(conversation_id), amount])
+
+	@staticmethod
+	def invalidate(user_ids):
+		keys = [unreads_key(user_id) for user_id in user_ids]
+		if keys:
+			get_redis_client().delete(*keys)
+
+	def read(self) -> dict | None:
+		""" Returns the counts by conversation id, or None when they have to be filled. """
+
+		counts = get_redis_client().hgetall(self.key)
+		if not counts:
+			return None
+
+		return {
+			field.decode(): int(count) for field, count in counts.items()
+			if field.decode() != PRESENT
+		}
+
+	def set(self, conversation_id, count) -> bool:
+		return bool(get_script(SET_SCRIPT)(keys= [self.key], args= [str(conversation_id), count]))
+
+	def fill(self, counts: dict):
+		""" Replaces every count of the user with `counts`. """
+
+		mapping = {str(conversation_id): count for conversation_id, count in counts.items()}
+
+		pipeline = get_redis_client().pipeline()
+		pipeline.delete(self.key)
+		pipeline.hset(self.key, mapping= {PRESENT: 1, **mapping})
+		pipeline.expire(self.key, self.timeout)
+		pipeline.execute()
+
+	def clear(self):
+		get_redis_client().delete(self.key)
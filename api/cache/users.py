@@ -0,0 +1,103 @@
+import json
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS
+
+from api.cache.client import get_redis_client
+from api.cache.local import LocalLRUCache
+from api.metrics import metrics
+
+
+# Users resolved by this process, by (user id, token id), as (expiry, user fields).
+local_users = LocalLRUCache(settings.AUTH_USER_LOCAL_MAX_ENTRIES)
+
+
+def user_key(user_id) -> str:
+	return f"auth:user:{user_id}"
+
+
+class AuthenticatedUserCache:
+	"""
+	Users resolved from access tokens, by user and token id: kept by the process for
+	AUTH_USER_LOCAL_TIMEOUT seconds and in a Redis hash of the user for
+	AUTH_USER_CACHE_TIMEOUT. Their password is left out, it is deferred on the users
+	returned and only loaded from the database if used.
+	"""
+
+	def __init__(self, user_id, token_id):
+		self.user_id = user_id
+		self.token_id = token_id
+
+	def get(self):
+		""" The cached user, or None. """
+
+		fields = self._get_local()
+		if fields is not None:
+			metrics.incr("auth.user_cache.local_hits")
+		else:
+			fields = self._get_shared()
+
+		metrics.observe("auth.user_cache.hit", int(fields is not None))
+
+		if fields is None:
+			return None
+
+		User = get_user_model()
+		model_fields = {field.attname: field for field in User._meta.concrete_fields}
+		names = list(fields)
+		values = [model_fields[name].to_python(fields[name]) for name in names]
+
+		return User.from_db(DEFAULT_DB_ALIAS, names, values)
+
+	def set(self, user):
+		fields = {
+			field.attname: field.value_from_object(user)
+			for field in user._meta.concrete_fields if field.attname != "password"
+		}
+		fields = json.loads(json.dumps(fields, cls= DjangoJSONEncoder))
+
+		self._set_local(fields)
+
+		if settings.AUTH_USER_CACHE_TIMEOUT:
+			pipeline = get_redis_client().pipeline()
+			pipeline.hset(user_key(self.user_id), self.token_id, json.dumps(fields))
+			pipeline.expire(user_key(self.user_id), settings.AUTH_USER_CACHE_TIMEOUT)
+			pipeline.execute()
+
+	@staticmethod
+	def invalidate(user_id):
+		""" Forgets the user under every token, in Redis and in this process. """
+
+		get_redis_client().delete(user_key(user_id))
+		local_users.delete_matching(lambda key: key[0] == str(user_id))
+
+	def _get_local(self):
+		entry = local_users.get((str(self.user_id), self.token_id))
+		if entry is None or entry[0] < time.monotonic():
+			return None
+
+		return entry[1]
+
+	def _set_local(self, fields):
+		if settings.AUTH_USER_LOCAL_TIMEOUT:
+			local_users.set(
+				(str(self.user_id), self.token_id),
+				(time.monotonic() + settings.AUTH_USER_LOCAL_TIMEOUT, fields),
+				1
+			)
+
+	def _get_shared(self):
+		if not settings.AUTH_USER_CACHE_TIMEOUT:
+			return None
+
+		fields = get_redis_client().hget(user_key(self.user_id), self.token_id)
+		if fields is None:
+			return None
+
+		fields = json.loads(fields)
+		self._set_local(fields)
+
+		return fields
@@ -0,0 +1,27 @@
+import uuid
+
+from django.utils import timezone
+
+
+def sample_message() -> dict:
+	""" A text message as rendered in new.message events, for the benchmark commands. """
+
+	return {
+		"id": str(uuid.uuid4()),
+		"conversation": str(uuid.uuid4()),
+		"message_type": "text",
+		"media_url": None,
+		"text": "Are we still on for the review at three? I moved the notes to the shared folder.",
+		"is_mine": False,
+		"sent_at": timezone.now().isoformat(),
+		"updated_at": None,
+		"deleted_at": None,
+		"sent_by": {
+			"id": 42,
+			"email": "ada@example.com",
+			"first_name": "Ada",
+			"last_name": "Lovelace",
+			"is_active": True,
+		},
+		"seen_by": [],
+	}
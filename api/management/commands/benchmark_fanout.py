@@ -0,0 +1,58 @@
+import json
+import time
+
+import msgpack
+from django.core.management.base import BaseCommand
+
+from api.management.benchmarks import sample_message
+from api.v1.utils import encode_event
+
+
+class Command(BaseCommand):
+	help = (
+		"Measures the CPU time spent delivering one new.message event to every socket of "
+		"a room, encoding it per socket versus once by the producer."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--recipients", type= int, default= 5000)
+		parser.add_argument("--rounds", type= int, default= 5)
+
+	def handle(self, *args, **options):
+		event = {"type": "new.message", "message": sample_message()}
+		recipients = options["recipients"]
+
+		def per_socket():
+			# The channel layer carries the event dict and every consumer encodes it.
+			payload = msgpack.packb({"type": "send.message", "message": event})
+			for _ in range(recipients):
+				json.dumps({"message": msgpack.unpackb(payload)["message"]})
+
+		def pre_encoded():
+			# The producer encodes the frame once and consumers pass the text through.
+			payload = msgpack.packb({"type": "send.message", "text": encode_event(event)})
+			for _ in range(recipients):
+				msgpack.unpackb(payload)["text"]
+
+		results = {
+			name: self.measure(run, options["rounds"])
+			for name, run in [("per_socket", per_socket), ("pre_encoded", pre_encoded)]
+		}
+		saved = results["per_socket"] - results["pre_encoded"]
+
+		for name, seconds in results.items():
+			self.stdout.write(f"{name}: {seconds * 1000:.2f} ms CPU per fan-out to {recipients} sockets")
+
+		self.stdout.write(
+			f"saved: {saved * 1000:.2f} ms per fan-out ({saved / recipients * 1e6:.2f} us per socket)")
+
+	def measure(self, run, rounds):
+		""" Best CPU time of `rounds` runs. """
+
+		timings = []
+		for _ in range(rounds):
+			started_at = time.process_time()
+			run()
+			timings.append(time.process_time() - started_at)
+
+		return min(timings)
@@ -0,0 +1,63 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from api.management.benchmarks import sample_message
+from api.v1.utils import SUBPROTOCOLS, encode_frame, decode_frame
+
+
+class Command(BaseCommand):
+	help = "Measures the size and the encode/decode time of websocket frames for every subprotocol."
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--conversations", type= int, default= 200,
+			help= "Number of conversations in the user.connected frame.")
+		parser.add_argument("--rounds", type= int, default= 200)
+
+	def handle(self, *args, **options):
+		frames = {
+			"new.message": {"message": {"type": "new.message", "message": sample_message()}},
+			"user.connected": {"message": {
+				"type": "user.connected",
+				"message": self.sample_conversations(options["conversations"])
+			}},
+			"ack": {"message": {"type": "ack", "id": "42", "message": None}},
+		}
+
+		self.stdout.write(f"{'frame':<16}{'protocol':<18}{'bytes':>10}{'encode us':>12}{'decode us':>12}")
+
+		for name, frame in frames.items():
+			for protocol in SUBPROTOCOLS:
+				encoded = encode_frame(frame, protocol)
+				size = len(encoded.get("text_data", "").encode() or encoded.get("bytes_data"))
+
+				encode_time = self.measure(lambda: encode_frame(frame, protocol), options["rounds"])
+				decode_time = self.measure(lambda: decode_frame(**encoded, protocol= protocol), options["rounds"])
+
+				self.stdout.write(
+					f"{name:<16}{protocol:<18}{size:>10}{encode_time * 1e6:>12.1f}{decode_time * 1e6:>12.1f}")
+
+	def measure(self, run, rounds):
+		""" Mean CPU time of `run`. """
+
+		started_at = time.process_time()
+		for _ in range(rounds):
+			run()
+
+		return (time.process_time() - started_at) / rounds
+
+	def sample_conversations(self, count):
+		conversations = {}
+		for i in range(count):
+			conversation_id = str(uuid.uuid4())
+			conversations[conversation_id] = {
+				"unreads": i % 7,
+				"id": conversation_id,
+				"name": f"Project room {i}",
+				"is_private": bool(i % 2),
+				"created_by": "Ada Lovelace",
+			}
+
+		return conversations
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from api.cache import get_redis_client
+from api.v1.utils import OUTBOX_WAKEUP_KEY, dispatch_outbox
+
+
+class Command(BaseCommand):
+	help = "Broadcasts the conversation events of the outbox as they are committed."
+
+	def add_arguments(self, parser):
+		parser.add_argument("--batch-size", type= int, default= 100)
+		parser.add_argument(
+			"--wait", type= float, default= 5.0,
+			help= "Seconds to wait for committed events before looking for them anyway.")
+		parser.add_argument("--once", action= "store_true", help= "Exit once the outbox is empty.")
+
+	def handle(self, *args, **options):
+		client = get_redis_client()
+
+		while True:
+			sent = dispatch_outbox(options["batch_size"])
+
+			if sent == options["batch_size"]:
+				continue
+
+			if options["once"]:
+				break
+
+			client.blpop(OUTBOX_WAKEUP_KEY, timeout= options["wait"])
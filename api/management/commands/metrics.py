@@ -0,0 +1,23 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.metrics import metrics
+
+
+class Command(BaseCommand):
+	help = "Prints the counters, timings and gauges collected by every worker."
+
+	def add_arguments(self, parser):
+		parser.add_argument("prefix", nargs= "?", default= "", help= "Only show metrics starting with it.")
+		parser.add_argument("--reset", action= "store_true", help= "Clear the metrics after printing them.")
+
+	def handle(self, *args, **options):
+		data = {
+			name: value for name, value in metrics.snapshot().items()
+			if name.startswith(options["prefix"])
+		}
+		self.stdout.write(json.dumps(data, indent= 2))
+
+		if options["reset"]:
+			metrics.reset()
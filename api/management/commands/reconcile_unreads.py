@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from api.cache import get_redis_client
+from api.models import User
+from api.v1.utils import reconcile_unreads
+
+
+class Command(BaseCommand):
+	help = "Recounts the cached unread counters of users from the database."
+
+	def add_arguments(self, parser):
+		parser.add_argument("users", nargs= "*", help= "Ids of the users to reconcile, every user with counters by default.")
+
+	def handle(self, *args, **options):
+		user_ids = options["users"] or [
+			key.decode().rsplit(":", 1)[1]
+			for key in get_redis_client().scan_iter(match= "unreads:user:*", count= 1000)
+		]
+
+		reconciled = 0
+		for user in User.objects.filter(id__in= user_ids).iterator():
+			reconcile_unreads(user)
+			reconciled += 1
+
+		self.stdout.write(f"Reconciled the unread counters of {reconciled} users.")
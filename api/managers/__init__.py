@@ -1 +1 @@
-from api.managers.conversation import CachedMessageQuerySet
\ No newline at end of file
+from api.managers.conversation import ConversationQuerySet, CachedMessageQuerySet
\ No newline at end of file
@@ -1,35 +1,213 @@
+
+from django.apps import apps
 from django.db import models
-from django.core.cache import cache
+from django.db.models import Count, F, FilteredRelation, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import IsNull
+
+from api.cache import ConversationMessageCache, CachedMessage, message_key, parse_message_key
+from api.metrics import metrics
+
+class ConversationQuerySet(models.QuerySet):
+
+	def with_member_details(self, user):
+		"""
+		Annotates each conversation with when the user joined it (`joined_at`), their read
+		cursor (`last_read_at`) and how many messages they haven't read (`number_of_unreads`,
+		see `CachedMessageQuerySet.unread_by`), all within the statement fetching the
+		conversations.
+		"""
+
+		unreads = apps.get_model("api", "Message").objects.filter(
+			conversation= OuterRef("pk")
+			).filter(
+				Q(sent_at__gt= OuterRef("member__last_read_at")) |
+				Q(IsNull(OuterRef("member__last_read_at"), True), sent_at__gte= OuterRef("member__joined_at"))
+			).exclude(
+				sent_by= user
+			).order_by().values("conversation").annotate(count= Count("pk")).values("count")
+
+		return self.annotate(
+			member= FilteredRelation("conversationmembers", condition= Q(conversationmembers__user= user)),
+		).annotate(
+			joined_at= F("member__joined_at"),
+			last_read_at= F("member__last_read_at"),
+			number_of_unreads= Coalesce(Subquery(unreads), Value(0)),
+		)
+
 
 class CachedMessageQuerySet(models.QuerySet):
-	
-	def get_messages(self, conversation_id, offset, limit, count= 500):
-		start_index = offset
-		end_index = offset + limit
-
-		cache_key = f"messages:conversation:{conversation_id}"
-		cached_messages = cache.get(cache_key)
-
-		if cached_messages is None:
-			cache_key = f"messages:conversation:{conversation_id}"
-			cached_messages = list(
-				self.model.objects.filter(
-					conversation_id= conversation_id
-					).order_by('-sent_at')[:count]
+
+	def latest_first(self):
+		return self.order_by('-sent_at', '-id')
+
+	def as_cached(self):
+		""" Evaluates the queryset into CachedMessage items, the form pages are served in. """
+
+		return [CachedMessage.from_message(message) for message in self.select_related("sent_by")]
+
+	def older_than(self, key):
+		""" Messages sent before the message a window key was built from. """
+
+		sent_at, message_id = parse_message_key(key)
+		return self.filter(sent_at__lte= sent_at).filter(
+			Q(sent_at__lt= sent_at) | Q(sent_at= sent_at, id__lt= message_id))
+
+	def newer_than(self, key):
+		""" Messages sent after the message a window key was built from. """
+
+		sent_at, message_id = parse_message_key(key)
+		return self.filter(sent_at__gte= sent_at).filter(
+			Q(sent_at__gt= sent_at) | Q(sent_at= sent_at, id__gt= message_id))
+
+	def unread_by(self, member):
+		"""
+		Messages of the member's conversation past their read cursor, or since they
+		joined when they haven't read anything yet. Their own messages don't count.
+		"""
+
+		if member.last_read_at:
+			messages = self.filter(conversation_id= member.conversation_id, sent_at__gt= member.last_read_at)
+		else:
+			messages = self.filter(conversation_id= member.conversation_id, sent_at__gte= member.joined_at)
+
+		return messages.exclude(sent_by_id= member.user_id)
+
+	def get_messages(self, conversation_id, offset, limit, count= None):
+		window = ConversationMessageCache(conversation_id, count)
+
+		cached = self.read_window(
+			window,
+			read= lambda: window.read(offset, offset + limit - 1),
+			slice= lambda floor, window_size, messages: (
+				floor, window_size, messages[offset:offset + limit]
+			)
+		)
+
+		if cached is None:
+			return self.filter(
+				conversation_id= conversation_id
+			).latest_first()[offset:offset + limit].as_cached()
+
+		floor, window_size, messages = cached
+
+		if floor and (offset + limit > window_size):
+			db_offset = max(0, offset - window_size)
+			messages += self.filter(
+				conversation_id= conversation_id
+			).older_than(floor).latest_first()[db_offset:db_offset + limit - len(messages)].as_cached()
+
+		return messages
+
+	def get_page(self, conversation_id, limit, before= None, after= None, count= None):
+		"""
+		Keyset counterpart of `get_messages`. Returns, newest first, up to `limit + 1`
+		messages right before the `before` key (the latest ones when no key is given) or
+		right after the `after` key; the extra message tells whether there is more.
+		Both the cache and the database are read with a seek on (sent_at, id), so deep
+		pages cost the same as the first one.
+		"""
+
+		window = ConversationMessageCache(conversation_id, count)
+		messages = self.filter(conversation_id= conversation_id)
+
+		if after:
+			cached = self.read_window(
+				window,
+				read= lambda: window.read_after(after, limit + 1),
+				slice= lambda floor, window_size, messages: (
+					floor, window_size,
+					[message for message in reversed(messages) if message.key > after][:limit + 1]
 				)
-			
-			cache.set(cache_key, cached_messages, timeout= 60*60*24)
-
-		if (end_index > count) and (len(cached_messages) == count):
-			db_start_index = max(0, start_index - count)
-			db_end_index = end_index - count
-			db_messages = list(
-				self.model.objects.filter(
-					conversation_id=conversation_id
-				).order_by('-sent_at')[db_start_index:db_end_index]
 			)
-			messages = cached_messages + db_messages
-		else:
-			messages = cached_messages[start_index:end_index]
 
-		return messages
\ No newline at end of file
+			floor, _, page = cached or (None, 0, [])
+
+			if cached is None or (floor and after < floor):
+				page = messages.newer_than(after).order_by('sent_at', 'id')[:limit + 1].as_cached()
+
+			return page[::-1]
+
+		cached = self.read_window(
+			window,
+			read= lambda: window.read_before(before, limit + 1),
+			slice= lambda floor, window_size, messages: (
+				floor, window_size,
+				[message for message in messages if not before or message.key < before][:limit + 1]
+			)
+		)
+
+		if cached is None:
+			messages = messages.older_than(before) if before else messages
+			return messages.latest_first()[:limit + 1].as_cached()
+
+		floor, _, page = cached
+
+		if floor and len(page) <= limit:
+			boundary = min(before, floor) if before else floor
+			page += messages.older_than(boundary).latest_first()[:limit + 1 - len(page)].as_cached()
+
+		return page
+
+	def read_window(self, window: ConversationMessageCache, read, slice):
+		"""
+		Reads from the cached window of a conversation with `read`, rebuilding the window
+		when it is missing. Only one worker rebuilds a given window at a time (single
+		flight): the others get None and read their page from the database right away,
+		rather than holding up their thread. Pages computed from a freshly loaded window
+		are cut with `slice`.
+		"""
+
+		cached = read()
+		if cached is not None:
+			metrics.incr("message_cache.hit")
+			return cached
+
+		metrics.incr("message_cache.miss")
+
+		rebuilt = self.rebuild_window(window)
+		if rebuilt is not None:
+			return slice(*rebuilt)
+
+		metrics.incr("message_cache.bypass")
+		return None
+
+	def load_window(self, window: ConversationMessageCache):
+		""" Returns the floor and the messages the window of a conversation should hold. """
+
+		messages = list(
+			self.filter(
+				conversation_id= window.conversation_id
+				).select_related("sent_by").latest_first()[:window.size + 1]
+			)
+
+		floor = ""
+		if len(messages) > window.size:
+			messages = messages[:window.size]
+			floor = message_key(messages[-1].sent_at, messages[-1].id)
+
+		return floor, messages
+
+	def rebuild_window(self, window: ConversationMessageCache):
+		"""
+		Reloads the cached window of a conversation from the database and returns it
+		in the same shape as `ConversationMessageCache.read`, or None when another
+		worker is already rebuilding it. Only needed when the window is missing or
+		corrupt, writes keep it up to date.
+		"""
+
+		token = window.begin_rebuild()
+		if token is None:
+			return None
+
+		metrics.incr("message_cache.rebuild")
+
+		try:
+			floor, messages = self.load_window(window)
+		except Exception:
+			window.abort_rebuild(token)
+			raise
+
+		window.commit_rebuild(token, messages, floor)
+
+		return floor, len(messages), [CachedMessage.from_message(message) for message in messages]
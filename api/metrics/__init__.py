@@ -0,0 +1 @@
+from api.metrics.collector import Metrics, metrics
\ No newline at end of file
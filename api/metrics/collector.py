@@ -0,0 +1,120 @@
+import logging
+import os
+import socket
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+from api.cache.client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+	"""
+	Process-local counters, timings and gauges, flushed to Redis hashes every
+	`flush_interval` seconds by the flush scheduler thread. Every worker contributes to
+	the same totals without paying a Redis round trip per event, nor ever blocking the
+	caller (or its event loop) on one. Read them with `snapshot` or `manage.py metrics`.
+
+	Gauges of a process are rewritten on every flush to a hash of their own, expiring
+	after `gauge_ttl` seconds, so those of workers that are gone stop counting.
+	"""
+
+	counters_key = "metrics:counters"
+	gauges_prefix = "metrics:gauges:"
+
+	def __init__(self, flush_interval= 1.0, gauge_ttl= 60):
+		self.flush_interval = flush_interval
+		self.gauge_ttl = gauge_ttl
+		self.lock = threading.Lock()
+		self.counters = Counter()
+		self.gauges = {}
+		self.reset_process()
+
+	def reset_process(self):
+		# A forked worker reports its gauges under its own pid.
+		self.process = f"{socket.gethostname()}:{os.getpid()}"
+
+	def incr(self, name, amount= 1):
+		with self.lock:
+			self.counters[name] += amount
+
+		self.maybe_flush()
+
+	def observe(self, name, value):
+		""" Records a timing (or any measurement): its count and total, from which the mean follows. """
+
+		with self.lock:
+			self.counters[f"{name}.count"] += 1
+			self.counters[f"{name}.total"] += value
+
+		self.maybe_flush()
+
+	def gauge(self, name, value):
+		""" Sets a per-process level, e.g. a queue depth. Gauges of all processes are summed on read. """
+
+		with self.lock:
+			self.gauges[name] = value
+
+		self.maybe_flush()
+
+	def maybe_flush(self):
+		""" Makes sure the scheduler flushes the metrics of this process. """
+
+		from api.v1.utils.scheduler import scheduler
+
+		if self.flush not in scheduler.periodic:
+			scheduler.call_every(self.flush_interval, self.flush)
+
+	def flush(self):
+		with self.lock:
+			counters, self.counters = self.counters, Counter()
+			gauges = dict(self.gauges)
+
+		if not (counters or gauges):
+			return
+
+		try:
+			pipe = get_redis_client().pipeline(transaction= False)
+			for name, amount in counters.items():
+				pipe.hincrbyfloat(self.counters_key, name, amount)
+			if gauges:
+				gauges_key = f"{self.gauges_prefix}{self.process}"
+				pipe.hset(gauges_key, mapping= gauges)
+				pipe.expire(gauges_key, self.gauge_ttl)
+			pipe.execute()
+
+		except Exception:
+			logger.exception("Failed to flush metrics.")
+
+	def snapshot(self) -> dict:
+		""" Returns the totals of every process, with gauges summed across processes. """
+
+		self.flush()
+		client = get_redis_client()
+
+		data = {
+			name.decode(): float(value)
+			for name, value in client.hgetall(self.counters_key).items()
+		}
+		for key in client.scan_iter(match= f"{self.gauges_prefix}*"):
+			for name, value in client.hgetall(key).items():
+				data[name.decode()] = data.get(name.decode(), 0) + float(value)
+
+		return dict(sorted(data.items()))
+
+	def reset(self):
+		with self.lock:
+			self.counters.clear()
+			self.gauges.clear()
+
+		client = get_redis_client()
+		client.delete(self.counters_key, *client.scan_iter(match= f"{self.gauges_prefix}*"))
+
+
+metrics = Metrics(flush_interval= settings.METRICS_FLUSH_INTERVAL, gauge_ttl= settings.METRICS_GAUGE_TTL)
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child= metrics.reset_process)
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 18:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0004_message_deleted_at"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["conversation", "sent_at", "id"], name="message_keyset_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.13 on 2026-10-18 18:13
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def backfill_read_cursors(apps, schema_editor):
+    """Points every member's read cursor at the latest message they have seen."""
+
+    ConversationMembers = apps.get_model("api", "ConversationMembers")
+    MessageViewers = apps.get_model("api", "MessageViewers")
+
+    latest_seen = MessageViewers.objects.filter(
+        user_id=OuterRef("user_id"),
+        message__conversation_id=OuterRef("conversation_id"),
+    ).order_by("-message__sent_at", "-message_id")
+
+    ConversationMembers.objects.update(
+        last_read_message_id=Subquery(latest_seen.values("message_id")[:1]),
+        last_read_at=Subquery(latest_seen.values("message__sent_at")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0005_message_keyset_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversationmembers",
+            name="last_read_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="conversationmembers",
+            name="last_read_message",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="api.message",
+            ),
+        ),
+        migrations.RunPython(backfill_read_cursors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.13 on 2026-10-18 18:18
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def drop_duplicate_viewers(apps, schema_editor):
+    """Keeps the first receipt of every (user, message) pair."""
+
+    MessageViewers = apps.get_model("api", "MessageViewers")
+
+    duplicates = (
+        MessageViewers.objects.values("user_id", "message_id")
+        .annotate(first=Min("id"), receipts=Count("id"))
+        .filter(receipts__gt=1)
+    )
+
+    for duplicate in duplicates.iterator():
+        MessageViewers.objects.filter(
+            user_id=duplicate["user_id"], message_id=duplicate["message_id"]
+        ).exclude(id=duplicate["first"]).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0006_conversationmembers_read_cursor"),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_viewers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="messageviewers",
+            constraint=models.UniqueConstraint(
+                fields=("user", "message"), name="unique_message_viewer"
+            ),
+        ),
+    ]
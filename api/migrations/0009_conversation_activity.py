@@ -0,0 +1,64 @@
+# Generated by Django 4.2.13 on 2026-10-18 19:03
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def backfill_activity(apps, schema_editor):
+    Conversation = apps.get_model("api", "Conversation")
+    Message = apps.get_model("api", "Message")
+
+    for conversation in Conversation.objects.iterator():
+        messages = Message.objects.filter(conversation_id=conversation.pk)
+        last = messages.order_by("-sent_at", "-id").first()
+
+        conversation.message_count = messages.count()
+        conversation.last_message_at = last.sent_at if last else conversation.created_at
+        conversation.last_message = last and {
+            "id": str(last.id),
+            "sent_by": last.sent_by_id,
+            "message_type": last.message_type,
+            "text": None if last.deleted_at or last.text is None else last.text[:100],
+            "media_url": None if last.deleted_at else last.media_url,
+            "sent_at": last.sent_at,
+            "deleted": last.deleted_at is not None,
+        }
+        conversation.save(
+            update_fields=["message_count", "last_message_at", "last_message"]
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0008_outboxevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="last_message",
+            field=models.JSONField(
+                blank=True,
+                encoder=django.core.serializers.json.DjangoJSONEncoder,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="last_message_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="conversation",
+            name="message_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="conversation",
+            index=models.Index(
+                fields=["-last_message_at", "-id"], name="conversation_inbox_idx"
+            ),
+        ),
+        migrations.RunPython(backfill_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.13 on 2026-10-18 19:24
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.utils.timezone
+
+
+def backfill_activity(apps, schema_editor):
+    Conversation = apps.get_model("api", "Conversation")
+    ConversationMembers = apps.get_model("api", "ConversationMembers")
+
+    ConversationMembers.objects.update(
+        last_message_at=Subquery(
+            Conversation.objects.filter(id=OuterRef("conversation_id")).values(
+                "last_message_at"
+            )[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("api", "0009_conversation_activity"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="conversation",
+            name="conversation_inbox_idx",
+        ),
+        migrations.AddField(
+            model_name="conversationmembers",
+            name="last_message_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="conversationmembers",
+            index=models.Index(
+                fields=["user", "-last_message_at", "conversation"],
+                name="member_inbox_idx",
+            ),
+        ),
+    ]
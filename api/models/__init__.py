@@ -1,2 +1,3 @@
 from api.models.user import User
-from api.models.conversation import Conversation, Message, ConversationMembers, MessageViewers
\ No newline at end of file
+from api.models.conversation import Conversation, Message, ConversationMembers, MessageViewers
+from api.models.outbox import OutboxEvent
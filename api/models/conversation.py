@@ -1,10 +1,12 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
 import uuid
 
 from api.models import User
 from api.enums import MessageTypeEnum
-from api.managers import CachedMessageQuerySet
+from api.managers import ConversationQuerySet, CachedMessageQuerySet
 
 null_blank = {"null": True, "blank": True}
 
@@ -32,6 +34,14 @@ class Conversation(models.Model):
 	updated_at= models.DateTimeField(**null_blank)
 	is_private= models.BooleanField(default= False)
 
+	# Activity kept up to date by the message write path, for the inbox: when the last
+	# message was sent (or the conversation created), its preview and the number of messages.
+	last_message_at= models.DateTimeField(default= timezone.now)
+	last_message= models.JSONField(encoder= DjangoJSONEncoder, **null_blank)
+	message_count= models.PositiveIntegerField(default= 0)
+
+	objects= ConversationQuerySet.as_manager()
+
 	def to_dict(self):
 		return {
 			"id": str(self.id),
@@ -52,6 +62,24 @@ class ConversationMembers(models.Model):
 	joined_at= models.DateTimeField(auto_now_add= True)
 	is_admin= models.BooleanField(default= False)
 
+	# Read cursor: everything sent up to `last_read_at` counts as read by the member.
+	last_read_at= models.DateTimeField(**null_blank)
+	last_read_message= models.ForeignKey(
+		"Message",
+		on_delete= models.SET_NULL,
+		related_name= "+",
+		**null_blank
+	)
+
+	# `last_message_at` of the conversation, copied to every member so that the inbox of
+	# a user is a range of `member_inbox_idx`.
+	last_message_at= models.DateTimeField(default= timezone.now)
+
+	class Meta:
+		indexes= [
+			models.Index(fields= ["user", "-last_message_at", "conversation"], name= "member_inbox_idx"),
+		]
+
 
 class Message(models.Model):
 	""" Message model. """
@@ -87,12 +115,52 @@ class Message(models.Model):
 
 	objects= CachedMessageQuerySet.as_manager()
 
+	# Fields whose changes are broadcast to the conversation, see `changed_fields`.
+	TRACKED_FIELDS= ("message_type", "media_url", "text", "updated_at", "deleted_at")
+
+	class Meta:
+		indexes= [
+			models.Index(fields= ["conversation", "sent_at", "id"], name= "message_keyset_idx"),
+		]
+
 	def __str__(self):
 		return f"{self.id}"
+
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		instance= super().from_db(db, field_names, values)
+		instance.remember_values()
+
+		return instance
+
+	def remember_values(self):
+		""" Keeps the loaded (or just saved) values of the tracked fields, see `changed_fields`. """
+
+		self._saved_values= {
+			name: getattr(self, name)
+			for name in self.TRACKED_FIELDS if name not in self.get_deferred_fields()
+		}
+
+	def changed_fields(self) -> list:
+		""" Tracked fields changed since the message was loaded or saved, all of them if unknown. """
+
+		saved_values= getattr(self, "_saved_values", None)
+		if saved_values is None:
+			return list(self.TRACKED_FIELDS)
+
+		return [
+			name for name in self.TRACKED_FIELDS
+			if name in saved_values and getattr(self, name) != saved_values[name]
+		]
 	
 class MessageViewers(models.Model):
 	""" Holds users that have seen a message. """
 	
 	user= models.ForeignKey(User, on_delete= models.CASCADE)
 	message= models.ForeignKey(Message, on_delete= models.CASCADE)
-	seen_at= models.DateTimeField(auto_now= True)
\ No newline at end of file
+	seen_at= models.DateTimeField(auto_now= True)
+
+	class Meta:
+		constraints= [
+			models.UniqueConstraint(fields= ["user", "message"], name= "unique_message_viewer"),
+		]
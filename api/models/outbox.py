@@ -0,0 +1,16 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+
+
+class OutboxEvent(models.Model):
+	"""
+	Conversation event waiting to be broadcast. Written in the transaction that caused
+	it and sent by the `dispatch_outbox` command once committed, in id order.
+	"""
+
+	conversation_id= models.UUIDField()
+	event= models.JSONField(encoder= DjangoJSONEncoder)
+	created_at= models.DateTimeField(auto_now_add= True)
+
+	def __str__(self):
+		return f"{self.id}-{self.event.get('type')}"
@@ -0,0 +1,23 @@
+import pytest
+
+from api.cache import get_redis_client
+from api.v1.utils import scheduler
+
+
+@pytest.fixture(autouse= True)
+def fresh_redis():
+	"""
+	Test users get the same ids from one test to the next, so none of their Redis
+	state (presence, counters, throttles...) may outlive a test.
+	"""
+
+	yield
+	get_redis_client().flushdb()
+
+
+@pytest.fixture(autouse= True)
+def no_pending_flushes():
+	""" Flushes left by a test would run during the next ones, or after the test database is gone. """
+
+	yield
+	scheduler.cancel_pending()
@@ -1,14 +1,52 @@
+import asyncio
+import json
+import sys
+import threading
+from datetime import timedelta
+from functools import partial
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import transaction
+from django.utils import timezone
 from rest_framework.test import APIClient
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework import status 
+from rest_framework.throttling import ScopedRateThrottle
 
 from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
+from channels.layers import channel_layers, get_channel_layer
+from asgiref.sync import async_to_sync
 from model_bakery import  baker
 import pytest
 
 from chat_app.asgi import application
-from api.models import  User, Conversation, ConversationMembers
+from api.models import  User, Conversation, ConversationMembers, Message, MessageViewers, OutboxEvent
+from api.cache import ConversationMessageCache, UnreadCounters, get_redis_client, message_key
+from api.cache.conversation import local_cache
+from api.v1.serializers.conversation import SimpleMessageSerializer
+from api.v1.consumers.conversation import ConversationConsumer
+from api.v1.utils import (
+	choose_subprotocol, encode_frame, decode_frame, update_presence, update_typing,
+	DatabaseExecutor, DatabaseUnavailable, FlushScheduler, dispatch_outbox, scheduler, sweep_presence,
+	group_add_many, group_discard_many)
+from api.metrics import Metrics, metrics
+
+
+@pytest.fixture(autouse= True)
+def fresh_channel_layer():
+	""" The Redis channel layer keeps receive state tied to an event loop, every test runs its own. """
+
+	yield
+	channel_layers.backends.clear()
+
+
+@pytest.fixture(autouse= True)
+def send_events_directly(settings):
+	""" Events wait for the transaction to commit in the outbox, which tests never do. """
+
+	settings.CONVERSATION_EVENTS_OUTBOX = False
 
 
 @pytest.fixture
@@ -62,6 +100,598 @@ class TestConversationAuthorization:
 		assert response.status_code == status.HTTP_403_FORBIDDEN
 
 
+@pytest.mark.django_db
+class TestReadCursor:
+
+	def test_mark_message_read_advances_cursor_and_clears_unreads(self):
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		member = baker.make(ConversationMembers, user= user, conversation= conversation)
+		messages = baker.make(Message, conversation= conversation, _quantity= 3)
+
+		assert Message.objects.unread_by(member).count() == 3
+
+		client.force_authenticate(user)
+		url= f'/api/v1/conversations/{conversation.id}/mark_message_read/'
+		client.post(url, {
+			"data": [{"message": messages[1].id, "seen_at": "2024-01-01T00:00:00Z"}]
+		}, format= "json")
+		member.refresh_from_db()
+
+		assert member.last_read_message == messages[1]
+		assert Message.objects.unread_by(member).count() == 1
+
+		client.post(url, {
+			"data": [{"message": messages[0].id, "seen_at": "2024-01-01T00:00:00Z"}]
+		}, format= "json")
+		member.refresh_from_db()
+
+		assert member.last_read_message == messages[1]
+
+	def test_bulk_read_is_idempotent_and_costs_constant_queries(self, django_assert_max_num_queries):
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		member = baker.make(ConversationMembers, user= user, conversation= conversation)
+		messages = baker.make(Message, conversation= conversation, _quantity= 50)
+
+		client.force_authenticate(user)
+		url= f'/api/v1/conversations/{conversation.id}/read/'
+		ids= [str(message.id) for message in messages]
+
+		with django_assert_max_num_queries(10):
+			response= client.post(url, {"messages": ids}, format= "json")
+
+		assert response.status_code == status.HTTP_204_NO_CONTENT
+
+		response= client.post(url, {"messages": ids}, format= "json")
+
+		assert response.status_code == status.HTTP_204_NO_CONTENT
+		assert MessageViewers.objects.filter(user= user).count() == 50
+		assert Message.objects.unread_by(ConversationMembers.objects.get(pk= member.pk)).count() == 0
+
+	def test_read_up_to_marks_everything_before(self):
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		member = baker.make(ConversationMembers, user= user, conversation= conversation)
+		messages = baker.make(Message, conversation= conversation, _quantity= 5)
+
+		client.force_authenticate(user)
+		url= f'/api/v1/conversations/{conversation.id}/read/'
+		response= client.post(url, {"up_to": str(messages[2].id)}, format= "json")
+		member.refresh_from_db()
+
+		assert response.status_code == status.HTTP_204_NO_CONTENT
+		assert member.last_read_message == messages[2]
+		assert list(MessageViewers.objects.filter(user= user).values_list("message_id", flat= True)) == [messages[2].id]
+		assert list(Message.objects.unread_by(member).order_by("sent_at")) == messages[3:]
+
+		other = baker.make(Message)
+		response= client.post(url, {"messages": [str(other.id)]}, format= "json")
+
+		assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+	def test_own_messages_are_not_unread(self):
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		member = baker.make(ConversationMembers, user= user, conversation= conversation)
+
+		client.force_authenticate(user)
+		client.post(
+			f'/api/v1/conversations/{conversation.id}/messages/', 
+			{"text": "hi", "message_type": "text"})
+		member.refresh_from_db()
+
+		assert member.last_read_at is not None
+		assert Message.objects.unread_by(member).count() == 0
+
+
+@pytest.mark.django_db
+class TestReadReceipts:
+
+	def test_receipts_are_coalesced_per_conversation(self, settings, monkeypatch):
+		settings.READ_RECEIPT_COALESCE_WINDOW = 60
+		broadcasts = []
+		flushes = []
+		monkeypatch.setattr(
+			"api.v1.utils.conversation.broadcast_conversation_event",
+			lambda conversation_id, event: broadcasts.append((conversation_id, event))
+		)
+		monkeypatch.setattr(scheduler, "call_later", lambda delay, func, *args: flushes.append(partial(func, *args)))
+
+		client= APIClient()
+		users = baker.make(User, _quantity= 2)
+		conversation = baker.make(Conversation)
+		conversation.members.add(*users)
+		messages = baker.make(Message, conversation= conversation, _quantity= 3)
+
+		for user, message in [(users[0], messages[0]), (users[0], messages[2]), (users[1], messages[1])]:
+			client.force_authenticate(user)
+			client.post(
+				f'/api/v1/conversations/{conversation.id}/read/', {"up_to": str(message.id)}, format= "json")
+
+		assert [event for conversation_id, event in broadcasts if conversation_id == conversation.id] == []
+		assert len(flushes) == 1
+
+		flushes[0]()
+
+		broadcasts = [event for conversation_id, event in broadcasts if conversation_id == conversation.id]
+
+		assert len(broadcasts) == 1
+		assert broadcasts[0]["type"] == "messages.seen"
+		assert sorted(
+			(receipt["user"], receipt["message"]) for receipt in broadcasts[0]["message"]
+		) == [(users[0].id, str(messages[2].id)), (users[1].id, str(messages[1].id))]
+
+	def test_receipts_are_sent_right_away_without_a_window(self, settings, monkeypatch):
+		settings.READ_RECEIPT_COALESCE_WINDOW = 0
+		broadcasts = []
+		monkeypatch.setattr(
+			"api.v1.utils.conversation.broadcast_conversation_event",
+			lambda conversation_id, event: broadcasts.append((conversation_id, event))
+		)
+
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		conversation.members.add(user)
+		message = baker.make(Message, conversation= conversation)
+
+		client.force_authenticate(user)
+		url= f'/api/v1/conversations/{conversation.id}/read/'
+		client.post(url, {"up_to": str(message.id)}, format= "json")
+		client.post(url, {"up_to": str(message.id)}, format= "json")
+
+		assert [event for conversation_id, event in broadcasts if conversation_id == conversation.id] == [{
+			"type": "messages.seen",
+			"message": [{"user": user.id, "message": str(message.id), "sent_at": message.sent_at.isoformat()}]
+		}]
+
+
+@pytest.mark.django_db
+class TestPresence:
+
+	def test_presence_changes_are_debounced(self, settings, monkeypatch):
+		settings.PRESENCE_DEBOUNCE = 60
+		broadcasts = []
+		flushes = []
+
+		async def group_send_many(layer, groups, message):
+			broadcasts.append((set(groups), json.loads(message["text"])["message"]))
+
+		monkeypatch.setattr("api.v1.utils.presence.group_send_many", group_send_many)
+		monkeypatch.setattr(scheduler, "call_later", lambda delay, func, *args: flushes.append(partial(func, *args)))
+
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		conversation.members.add(user)
+
+		update_presence(user.id, "first", True)
+		update_presence(user.id, "second", True)
+		update_presence(user.id, "first", False)
+
+		assert len(flushes) == 1
+
+		flushes[0]()
+
+		assert broadcasts == [
+			({str(conversation.id)}, {"type": "user.presence", "message": {"user": user.id, "online": True}})]
+
+		# Flapping within the window is never broadcast.
+		get_redis_client().delete(f"presence:user:{user.id}:debounce")
+		update_presence(user.id, "second", False)
+		update_presence(user.id, "third", True)
+		flushes[1]()
+
+		assert len(broadcasts) == 1
+
+	def test_lapsed_connections_are_swept_offline(self, settings, monkeypatch):
+		settings.PRESENCE_DEBOUNCE = 0
+		broadcasts = []
+
+		async def group_send_many(layer, groups, message):
+			broadcasts.append(json.loads(message["text"])["message"]["message"])
+
+		monkeypatch.setattr("api.v1.utils.presence.group_send_many", group_send_many)
+
+		user, other = baker.make(User, _quantity= 2)
+		conversation = baker.make(Conversation)
+		conversation.members.add(user, other)
+
+		update_presence(user.id, "crashed", True)
+		update_presence(other.id, "alive", True)
+
+		# The worker holding the connection died: no disconnect, no more heartbeats.
+		get_redis_client().zadd(f"presence:user:{user.id}:connections", {"crashed": 0})
+		get_redis_client().zadd("presence:users", {user.id: 0})
+
+		sweep_presence()
+		sweep_presence()
+
+		assert broadcasts == [
+			{"user": user.id, "online": True},
+			{"user": other.id, "online": True},
+			{"user": user.id, "online": False},
+		]
+
+		update_presence(other.id, "alive", False)
+
+		assert get_redis_client().zrange("presence:users", 0, -1) == []
+
+	def test_presence_of_members_is_returned_at_once(self, settings):
+		settings.PRESENCE_DEBOUNCE = 0
+		client= APIClient()
+		user, other = baker.make(User, _quantity= 2)
+		conversation = baker.make(Conversation)
+		conversation.members.add(user, other)
+
+		update_presence(other.id, "channel", True)
+
+		client.force_authenticate(user)
+		response= client.get(f'/api/v1/conversations/{conversation.id}/presence/')
+
+		assert response.status_code == status.HTTP_200_OK
+		assert response.data == {user.id: False, other.id: True}
+
+		update_presence(other.id, "channel", False)
+
+		assert client.get(f'/api/v1/conversations/{conversation.id}/presence/').data[other.id] is False
+
+
+@pytest.mark.django_db
+class TestTypingIndicators:
+
+	def test_typing_is_broadcast_once_per_interval(self, settings, monkeypatch):
+		settings.TYPING_BROADCAST_INTERVAL = 60
+		broadcasts = []
+		flushes = []
+		monkeypatch.setattr(
+			"api.v1.utils.conversation.broadcast_conversation_event",
+			lambda conversation_id, event, replayable= True: broadcasts.append((conversation_id, event))
+		)
+		monkeypatch.setattr(scheduler, "call_later", lambda delay, func, *args: flushes.append(partial(func, *args)))
+
+		users = baker.make(User, _quantity= 3)
+		conversation = baker.make(Conversation)
+
+		for user in [*users, users[0], users[1]]:
+			update_typing(user.id, conversation.id, True)
+
+		assert len(flushes) == 1
+
+		flushes[0]()
+		events = [event for conversation_id, event in broadcasts if conversation_id == conversation.id]
+
+		assert len(events) == 1
+		assert events[0]["type"] == "users.typing"
+		assert sorted(events[0]["message"]["users"]) == sorted(user.id for user in users)
+		assert events[0]["message"]["count"] == 3
+
+		get_redis_client().delete(f"typing:conversation:{conversation.id}:window")
+		update_typing(users[2].id, conversation.id, False)
+		update_typing(users[2].id, conversation.id, False)
+		flushes[1]()
+
+		assert len(flushes) == 2
+		assert [event for conversation_id, event in broadcasts if conversation_id == conversation.id][-1][
+			"message"]["count"] == 2
+
+
+@pytest.mark.django_db
+class TestFlushScheduler:
+
+	def test_flushes_run_once_due_from_one_thread(self):
+		flush_scheduler = FlushScheduler()
+		done = threading.Event()
+		calls = []
+
+		flush_scheduler.call_later(0.05, lambda: (calls.append("late"), done.set()))
+		flush_scheduler.call_later(0, calls.append, "early")
+		thread = flush_scheduler.thread
+
+		assert done.wait(timeout= 3)
+		assert calls == ["early", "late"]
+
+		flush_scheduler.call_later(0, calls.append, "again")
+		assert flush_scheduler.thread is thread
+
+	def test_periodic_calls_are_registered_once(self):
+		flush_scheduler = FlushScheduler()
+		flush_scheduler.thread = threading.current_thread()
+		calls = []
+		call = partial(calls.append, "sweep")
+
+		flush_scheduler.call_every(60, call)
+		flush_scheduler.call_every(60, call)
+		flush_scheduler.run_pending()
+
+		assert calls == ["sweep"]
+		assert len(flush_scheduler.queue) == 1
+
+	def test_metrics_are_flushed_by_the_scheduler(self):
+		collector = Metrics(flush_interval= 60, gauge_ttl= 30)
+
+		collector.incr("sweeps")
+		collector.gauge("sockets", 3)
+
+		assert not get_redis_client().exists(collector.counters_key)
+		assert collector.flush in scheduler.periodic
+
+		scheduler.run_pending()
+		gauges_key = f"{collector.gauges_prefix}{collector.process}"
+
+		assert 0 < get_redis_client().ttl(gauges_key) <= 30
+		assert get_redis_client().hget(gauges_key, "sockets") == b"3"
+		assert float(get_redis_client().hget(collector.counters_key, "sweeps")) == 1
+
+	def test_pending_flushes_run_on_exit(self):
+		flush_scheduler = FlushScheduler()
+		flush_scheduler.thread = threading.current_thread()
+		calls = []
+
+		flush_scheduler.call_later(120, calls.append, "second")
+		flush_scheduler.call_later(60, calls.append, "first")
+		flush_scheduler.run_pending()
+
+		assert calls == ["first", "second"]
+		assert flush_scheduler.queue == []
+
+
+@pytest.mark.django_db
+class TestOutbox:
+
+	def test_events_are_sent_after_the_request_in_order(self, settings, monkeypatch):
+		settings.CONVERSATION_EVENTS_OUTBOX = True
+		settings.CONVERSATION_ROUTING = "user"
+		sent = []
+
+		async def group_send_many(layer, groups, message):
+			sent.append((sorted(groups), json.loads(message["text"])))
+
+		monkeypatch.setattr("api.v1.utils.outbox.group_send_many", group_send_many)
+
+		client= APIClient()
+		admin, user = baker.make(User, _quantity= 2)
+		conversation = baker.make(Conversation, created_by= admin)
+		baker.make(ConversationMembers, user= admin, conversation= conversation, is_admin= True)
+
+		client.force_authenticate(admin)
+		client.post(f'/api/v1/conversations/{conversation.id}/add_member/', {"user": user.id})
+		client.post(
+			f'/api/v1/conversations/{conversation.id}/messages/', {"text": "hi", "message_type": "text"})
+
+		assert sent == []
+		assert OutboxEvent.objects.filter(conversation_id= conversation.id).count() == 2
+
+		dispatch_outbox()
+
+		assert [frame["message"]["type"] for _, frame in sent] == ["user.added", "new.message"]
+		assert [frame["seq"] for _, frame in sent] == [1, 2]
+		# The new member is told they were added.
+		assert sent[0][0] == sorted([f"user.{admin.id}", f"user.{user.id}"])
+		assert not OutboxEvent.objects.filter(conversation_id= conversation.id).exists()
+
+
+@pytest.mark.django_db
+class TestMessageEvents:
+
+	def test_edits_and_deletes_are_broadcast_as_deltas(self, monkeypatch):
+		broadcasts = []
+		monkeypatch.setattr(
+			"api.v1.signals.handlers.conversation.broadcast_conversation_event",
+			lambda conversation_id, event, replayable= True: broadcasts.append((conversation_id, event))
+		)
+
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		conversation.members.add(user)
+		message = baker.make(Message, conversation= conversation, sent_by= user, message_type= "text", text= "hi")
+		url= f'/api/v1/conversations/{conversation.id}/messages/{message.id}/'
+
+		client.force_authenticate(user)
+		client.patch(url, {"text": "edited"})
+		client.patch(url, {"text": "edited"})
+		client.delete(url)
+
+		events = [event for conversation_id, event in broadcasts if conversation_id == conversation.id]
+		message.refresh_from_db()
+		ids = {"id": str(message.id), "conversation": str(conversation.id)}
+
+		assert [event["type"] for event in events] == ["new.message", "message.updated", "message.updated", "message.deleted"]
+		assert set(events[1]["message"]) == {"id", "conversation", "text", "updated_at"}
+		assert events[1]["message"]["text"] == "edited"
+		# Editing to the same text only moves updated_at.
+		assert events[2]["message"] == {**ids, "updated_at": SimpleMessageSerializer(message).data["updated_at"]}
+		assert events[3]["message"] == {**ids, "deleted_at": SimpleMessageSerializer(message).data["deleted_at"]}
+
+
+@pytest.mark.django_db
+class TestUnreadCounters:
+
+	def test_counters_follow_new_and_read_messages(self, django_capture_on_commit_callbacks):
+		client= APIClient()
+		user = baker.make(User)
+		sender = baker.make(User)
+		conversation = baker.make(Conversation)
+		conversation.members.add(user, sender)
+
+		client.force_authenticate(user)
+		response= client.get('/api/v1/conversations/')
+
+		assert response.data["results"][0]["number_of_unreads"] == 0
+
+		with django_capture_on_commit_callbacks(execute= True):
+			messages = baker.make(Message, conversation= conversation, sent_by= sender, _quantity= 3)
+
+		assert UnreadCounters(user.id).read() == {str(conversation.id): 3}
+		assert UnreadCounters(sender.id).read() is None
+
+		with django_capture_on_commit_callbacks(execute= True):
+			with pytest.raises(RuntimeError):
+				with transaction.atomic():
+					baker.make(Message, conversation= conversation, sent_by= sender)
+					raise RuntimeError()
+
+		assert UnreadCounters(user.id).read() == {str(conversation.id): 3}
+
+		client.post(f'/api/v1/conversations/{conversation.id}/mark_message_read/', {
+			"data": [{"message": messages[1].id, "seen_at": "2024-01-01T00:00:00Z"}]
+		}, format= "json")
+		response= client.get('/api/v1/conversations/')
+
+		assert response.data["results"][0]["number_of_unreads"] == 1
+
+	def test_missing_or_drifted_counters_are_reconciled(self):
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		conversation.members.add(user)
+		baker.make(Message, conversation= conversation, _quantity= 2)
+
+		UnreadCounters(user.id).fill({conversation.id: 7})
+		call_command("reconcile_unreads", stdout= StringIO())
+
+		assert UnreadCounters(user.id).read() == {str(conversation.id): 2}
+
+		conversation.members.remove(user)
+
+		assert UnreadCounters(user.id).read() is None
+
+
+@pytest.mark.django_db
+class TestConversationList:
+
+	def test_annotated_unreads_match_read_cursors(self):
+		user = baker.make(User)
+		conversations = baker.make(Conversation, _quantity= 2)
+		messages = {}
+		for conversation in conversations:
+			conversation.members.add(user)
+			messages[conversation.id] = baker.make(Message, conversation= conversation, _quantity= 3)
+			baker.make(Message, conversation= conversation, sent_by= user)
+
+		ConversationMembers.objects.filter(
+			user= user, conversation= conversations[0]
+			).update(last_read_at= messages[conversations[0].id][0].sent_at)
+
+		annotated = Conversation.objects.filter(members= user).with_member_details(user)
+
+		for conversation in annotated:
+			member = ConversationMembers.objects.get(user= user, conversation= conversation)
+			assert conversation.joined_at == member.joined_at
+			assert conversation.number_of_unreads == Message.objects.unread_by(member).count()
+
+		assert {conversation.id: conversation.number_of_unreads for conversation in annotated} == {
+			conversations[0].id: 2, conversations[1].id: 3}
+
+	def test_conversation_list_queries_do_not_grow_with_conversations(self, django_assert_num_queries):
+		client= APIClient()
+		user = baker.make(User)
+		for conversation in baker.make(Conversation, _quantity= 20):
+			conversation.members.add(user)
+			baker.make(Message, conversation= conversation, _quantity= 2)
+
+		client.force_authenticate(user)
+		UnreadCounters(user.id).clear()
+
+		with django_assert_num_queries(3):
+			response= client.get('/api/v1/conversations/', {"limit": 20})
+
+		assert [conversation["number_of_unreads"] for conversation in response.data["results"]] == [2] * 20
+
+		with django_assert_num_queries(2):
+			client.get('/api/v1/conversations/', {"limit": 20})
+
+	def test_inbox_lists_most_recently_active_first_in_one_query(
+			self, django_assert_num_queries, django_capture_on_commit_callbacks):
+		client= APIClient()
+		user = baker.make(User)
+		conversations = baker.make(Conversation, _quantity= 3)
+		with django_capture_on_commit_callbacks(execute= True):
+			for conversation in conversations:
+				conversation.members.add(user)
+				baker.make(Message, conversation= conversation, _quantity= 2)
+
+			last = baker.make(Message, conversation= conversations[0], text= "latest")
+
+		# Joining lists the conversation by its last message, not at the top.
+		joined = baker.make(Conversation, last_message_at= timezone.now() - timedelta(days= 1))
+		joined.members.add(user)
+
+		client.force_authenticate(user)
+		client.get('/api/v1/conversations/inbox/')
+
+		with django_assert_num_queries(1):
+			response= client.get('/api/v1/conversations/inbox/', {"limit": 2})
+
+		first_page = response.data["results"]
+		assert [item["id"] for item in first_page] == [str(conversations[0].id), str(conversations[2].id)]
+		assert first_page[0]["last_message"]["id"] == str(last.id)
+		assert first_page[0]["last_message"]["text"] == "latest"
+		assert first_page[0]["message_count"] == 3
+		assert first_page[0]["number_of_unreads"] == 3
+
+		response= client.get(response.data["next"])
+
+		assert [item["id"] for item in response.data["results"]] == [str(conversations[1].id), str(joined.id)]
+		assert response.data["next"] is None
+
+	def test_last_message_follows_edits_and_deletes(self, django_capture_on_commit_callbacks):
+		conversation = baker.make(Conversation)
+		member = baker.make(ConversationMembers, conversation= conversation)
+
+		with django_capture_on_commit_callbacks(execute= True):
+			first, last = baker.make(Message, conversation= conversation, text= "hello", _quantity= 2)
+
+		member.refresh_from_db()
+		assert member.last_message_at == last.sent_at
+
+		with django_capture_on_commit_callbacks(execute= True):
+			last.text = "edited"
+			last.save()
+		conversation.refresh_from_db()
+		assert conversation.last_message["text"] == "edited"
+
+		with django_capture_on_commit_callbacks(execute= True):
+			first.text = "not the last one"
+			first.save()
+		conversation.refresh_from_db()
+		assert conversation.last_message["id"] == str(last.id)
+
+		with django_capture_on_commit_callbacks(execute= True):
+			Message.objects.get(id= last.id).delete()
+		conversation.refresh_from_db()
+		member.refresh_from_db()
+		assert conversation.message_count == 1
+		assert conversation.last_message["id"] == str(first.id)
+		assert conversation.last_message_at == member.last_message_at == first.sent_at
+
+
+	def test_websocket_connect_details_cost_constant_queries(self, settings, django_assert_num_queries):
+		# Queries are only counted on this thread, so the consumer's executor is left out.
+		settings.CONSUMER_DB_WORKERS = 0
+		user = baker.make(User)
+		creator = baker.make(User, first_name= "Ada", last_name= "Lovelace")
+		for conversation in baker.make(Conversation, created_by= creator, _quantity= 10):
+			conversation.members.add(user)
+			baker.make(Message, conversation= conversation)
+
+		UnreadCounters(user.id).clear()
+
+		with django_assert_num_queries(2):
+			details= async_to_sync(ConversationConsumer()._get_conversations_details)(user)
+
+		assert len(details) == 10
+		assert all(
+			conversation["unreads"] == 1 and conversation["created_by"] == "Ada Lovelace"
+			for conversation in details.values()
+		)
+
+
 @pytest.mark.django_db
 class TestMessageThrottling:
 	
@@ -126,4 +756,558 @@ class TestConversationConsumer:
 
 		await communicator.disconnect()
 
-	
\ No newline at end of file
+	async def test_disconnect_leaves_every_group_the_connection_joined(self):
+		user = await database_sync_to_async(baker.make)(User)
+		conversations = await database_sync_to_async(baker.make)(
+			Conversation, created_by= user, _quantity= 2)
+		for conversation in conversations:
+			await database_sync_to_async(conversation.members.add)(user)
+
+		communicator = WebsocketCommunicator(
+			application, 
+			f"ws/conversations/?token={RefreshToken.for_user(user).access_token}"
+		)
+		await communicator.connect()
+		await communicator.receive_json_from(timeout= 3)
+
+		groups = [str(conversation.id) for conversation in conversations]
+		assert [await group_size(group) for group in groups] == [1, 1]
+
+		added = await database_sync_to_async(baker.make)(Conversation, created_by= user)
+		await database_sync_to_async(added.members.add)(user)
+		await database_sync_to_async(conversations[0].members.remove)(user)
+
+		assert await wait_for_group_size(str(added.id), 1)
+		assert await wait_for_group_size(groups[0], 0)
+
+		await communicator.disconnect()
+
+		for group in [*groups, str(added.id), f"user.{user.id}"]:
+			assert await group_size(group) == 0
+
+
+	async def test_other_channels_redis_versions_join_groups_one_call_each(self, monkeypatch):
+		async def pipeline_by_shard(*args):
+			raise AssertionError("Private API of channels_redis used")
+
+		monkeypatch.setattr("api.v1.utils.channels.CHANNELS_REDIS_VERSION", "5.0.0")
+		monkeypatch.setattr("api.v1.utils.channels._pipeline_by_shard", pipeline_by_shard)
+		groups = ["first", "second"]
+
+		await group_add_many(get_channel_layer(), groups, "channel")
+
+		assert [await group_size(group) for group in groups] == [1, 1]
+
+		await group_discard_many(get_channel_layer(), groups, "channel")
+
+		assert [await group_size(group) for group in groups] == [0, 0]
+
+
+	async def test_events_routed_by_user_follow_membership_changes(self, settings):
+		settings.CONVERSATION_ROUTING = "user"
+		user = await database_sync_to_async(baker.make)(User)
+		conversation = await database_sync_to_async(baker.make)(Conversation, created_by= user)
+		await database_sync_to_async(conversation.members.add)(user)
+
+		communicator = WebsocketCommunicator(
+			application, 
+			f"ws/conversations/?token={RefreshToken.for_user(user).access_token}"
+		)
+		await communicator.connect()
+		await communicator.receive_json_from(timeout= 3)
+
+		assert await group_size(str(conversation.id)) == 0
+		assert await group_size(f"user.{user.id}") == 1
+
+		added = await database_sync_to_async(baker.make)(Conversation, created_by= user)
+		await database_sync_to_async(added.members.add)(user)
+		await database_sync_to_async(baker.make)(Message, conversation= added, text= "hi")
+
+		event = await communicator.receive_json_from(timeout= 3)
+		assert event["message"]["type"] == "new.message"
+		assert event["message"]["message"]["text"] == "hi"
+
+		await database_sync_to_async(added.members.remove)(user)
+		await database_sync_to_async(baker.make)(Message, conversation= added)
+
+		assert await communicator.receive_nothing(timeout= 0.3)
+
+		await communicator.disconnect()
+
+		assert await group_size(f"user.{user.id}") == 0
+
+
+	async def test_messages_are_sent_edited_read_and_deleted_over_the_socket(self):
+		user, other = await database_sync_to_async(baker.make)(User, _quantity= 2)
+		conversation = await database_sync_to_async(baker.make)(Conversation, created_by= user)
+		await database_sync_to_async(conversation.members.add)(user, other)
+
+		communicator = WebsocketCommunicator(
+			application, 
+			f"ws/conversations/?token={RefreshToken.for_user(user).access_token}"
+		)
+		await communicator.connect()
+		await communicator.receive_json_from(timeout= 3)
+
+		frame = {"conversation": str(conversation.id)}
+
+		await communicator.send_json_to({
+			**frame, "type": "message.create", "id": "1", "data": {"text": "hi", "message_type": "text"}})
+		created = await receive_reply(communicator, "1")
+
+		assert created["type"] == "ack"
+		assert created["message"]["text"] == "hi"
+
+		await communicator.send_json_to({
+			**frame, "type": "message.update", "id": "2",
+			"message": created["message"]["id"], "data": {"text": "edited"}
+		})
+		updated = await receive_reply(communicator, "2")
+
+		assert updated["message"]["text"] == "edited"
+
+		await communicator.send_json_to({
+			**frame, "type": "message.delete", "id": "3", "message": created["message"]["id"]})
+
+		assert (await receive_reply(communicator, "3"))["type"] == "ack"
+
+		received = await database_sync_to_async(baker.make)(Message, conversation= conversation, sent_by= other)
+		await communicator.send_json_to({
+			**frame, "type": "messages.read", "id": "4", "data": {"up_to": str(received.id)}})
+
+		assert (await receive_reply(communicator, "4"))["type"] == "ack"
+
+		member = await database_sync_to_async(ConversationMembers.objects.get)(user= user, conversation= conversation)
+		assert member.last_read_message_id == received.id
+
+		await communicator.send_json_to({
+			**frame, "type": "message.update", "id": "5", "message": str(received.id), "data": {"text": "mine"}})
+
+		assert (await receive_reply(communicator, "5"))["type"] == "error"
+
+		await communicator.send_to(text_data= "not json")
+
+		assert (await receive_reply(communicator, None))["type"] == "error"
+
+		await communicator.disconnect()
+
+	async def test_socket_messages_share_the_messages_rate_limit(self, monkeypatch):
+		monkeypatch.setattr(ScopedRateThrottle, "THROTTLE_RATES", {"messages": "2/minute", "user": None})
+		user = await database_sync_to_async(baker.make)(User)
+		conversation = await database_sync_to_async(baker.make)(Conversation, created_by= user)
+		await database_sync_to_async(conversation.members.add)(user)
+
+		client= APIClient()
+		client.force_authenticate(user)
+		await database_sync_to_async(client.get)(f'/api/v1/conversations/{conversation.id}/messages/')
+
+		communicator = WebsocketCommunicator(
+			application, 
+			f"ws/conversations/?token={RefreshToken.for_user(user).access_token}"
+		)
+		await communicator.connect()
+		await communicator.receive_json_from(timeout= 3)
+
+		frame = {"conversation": str(conversation.id), "type": "message.create", "data": {"text": "hi", "message_type": "text"}}
+
+		await communicator.send_json_to({**frame, "id": "1"})
+		assert (await receive_reply(communicator, "1"))["type"] == "ack"
+
+		await communicator.send_json_to({**frame, "id": "2"})
+		throttled = await receive_reply(communicator, "2")
+
+		assert throttled["type"] == "error"
+		assert "throttled" in throttled["message"]
+
+		await communicator.disconnect()
+
+
+	async def test_msgpack_and_deflate_subprotocols_are_negotiated(self):
+		user = await database_sync_to_async(baker.make)(User)
+		conversation = await database_sync_to_async(baker.make)(Conversation, created_by= user)
+		await database_sync_to_async(conversation.members.add)(user)
+
+		communicator = WebsocketCommunicator(
+			application, 
+			f"ws/conversations/?token={RefreshToken.for_user(user).access_token}",
+			subprotocols= ["msgpack.deflate"]
+		)
+		connected, subprotocol = await communicator.connect()
+
+		assert subprotocol == "msgpack.deflate"
+
+		connected_frame = decode_frame(
+			bytes_data= await communicator.receive_from(timeout= 3), protocol= subprotocol)
+
+		assert str(conversation.id) in connected_frame["message"]["message"]
+
+		await communicator.send_to(bytes_data= encode_frame({
+			"type": "message.create", "id": "1", "conversation": str(conversation.id),
+			"data": {"text": "hi", "message_type": "text"}
+		}, subprotocol)["bytes_data"])
+
+		frames = [
+			decode_frame(bytes_data= await communicator.receive_from(timeout= 3), protocol= subprotocol)
+			for _ in range(2)
+		]
+
+		assert {frame["message"]["type"] for frame in frames} == {"new.message", "ack"}
+
+		await communicator.disconnect()
+
+	async def test_deflated_frames_inflating_past_the_limit_are_rejected(self, settings):
+		settings.WEBSOCKET_MAX_FRAME_SIZE = 1024
+		frame = encode_frame({"type": "heartbeat", "data": "x" * 1024}, "json.deflate")["bytes_data"]
+
+		with pytest.raises(ValueError):
+			decode_frame(bytes_data= frame, protocol= "json.deflate")
+
+		frame = encode_frame({"type": "heartbeat"}, "json.deflate")["bytes_data"]
+		assert decode_frame(bytes_data= frame, protocol= "json.deflate") == {"type": "heartbeat"}
+
+		assert choose_subprotocol(["chat", "json"]) == "json"
+		assert choose_subprotocol(["chat"]) is None
+
+
+	async def test_resumed_session_receives_missed_events_or_resync(self):
+		user = await database_sync_to_async(baker.make)(User)
+		conversation = await database_sync_to_async(baker.make)(Conversation, created_by= user)
+		await database_sync_to_async(conversation.members.add)(user)
+		messages = await database_sync_to_async(baker.make)(Message, conversation= conversation, _quantity= 3)
+
+		communicator = WebsocketCommunicator(
+			application, 
+			f"ws/conversations/?token={RefreshToken.for_user(user).access_token}"
+		)
+		await communicator.connect()
+		connected = await communicator.receive_json_from(timeout= 3)
+
+		assert connected["message"]["message"][str(conversation.id)]["seq"] == 3
+
+		await communicator.send_json_to({"type": "resume", "id": "1", "data": {str(conversation.id): 1}})
+		replayed = [await communicator.receive_json_from(timeout= 3) for _ in range(2)]
+
+		assert [frame["seq"] for frame in replayed] == [2, 3]
+		assert [frame["message"]["message"]["id"] for frame in replayed] == [
+			str(message.id) for message in messages[1:]]
+		assert (await receive_reply(communicator, "1"))["message"] == {"replayed": 2, "resync": [], "removed": []}
+
+		get_redis_client().delete(f"events:conversation:{conversation.id}:stream")
+		await communicator.send_json_to({"type": "resume", "id": "2", "data": {str(conversation.id): 1}})
+
+		resync = await communicator.receive_json_from(timeout= 3)
+		assert resync["message"] == {"type": "resync", "message": {"conversation": str(conversation.id)}}
+		assert (await receive_reply(communicator, "2"))["message"]["resync"] == [str(conversation.id)]
+
+		left = await database_sync_to_async(baker.make)(Conversation)
+		await communicator.send_json_to(
+			{"type": "resume", "id": "3", "data": {str(left.id): 0, str(conversation.id): 3}})
+
+		assert (await receive_reply(communicator, "3"))["message"] == {
+			"replayed": 0, "resync": [], "removed": [str(left.id)]}
+
+		await communicator.disconnect()
+
+
+	async def test_slow_client_loses_droppable_frames_then_is_closed(self):
+		closed = []
+
+		async def close(code= None):
+			closed.append(code)
+
+		consumer = ConversationConsumer()
+		consumer.protocol = None
+		consumer.closing = False
+		consumer.outbox = asyncio.Queue(maxsize= 2)
+		consumer.close = close
+
+		await consumer.send_message({"text": '{"message": 1}'})
+		await consumer.send_message({"text": '{"message": 2}', "droppable": True})
+		await consumer.send_message({"text": '{"message": 3}'})
+
+		assert [consumer.outbox.get_nowait()["text_data"] for _ in range(2)] == [
+			'{"message": 1}', '{"message": 3}']
+
+		for number in range(3):
+			await consumer.send_message({"text": f'{{"message": {number}}}'})
+
+		assert closed == [ConversationConsumer.RESYNC_CLOSE_CODE]
+		assert consumer.outbox.qsize() == 2
+
+
+	async def test_database_executor_turns_down_calls_past_its_queue(self):
+		executor = DatabaseExecutor(workers= 1, queue_size= 1, timeout= 0.2)
+		release = threading.Event()
+
+		calls = [asyncio.ensure_future(executor.run(release.wait)) for _ in range(2)]
+		await asyncio.sleep(0)
+
+		with pytest.raises(DatabaseUnavailable):
+			await executor.run(release.wait)
+
+		for call in calls:
+			with pytest.raises(DatabaseUnavailable):
+				await call
+
+		release.set()
+		while executor.pending:
+			await asyncio.sleep(0.01)
+
+		assert await executor.run(lambda: 42) == 42
+
+
+async def receive_reply(communicator, frame_id):
+	""" Skips conversation events up to the ack or error of a frame. """
+
+	while True:
+		event = (await communicator.receive_json_from(timeout= 3))["message"]
+		if event["type"] in ["ack", "error"] and event["id"] == frame_id:
+			return event
+
+
+async def group_size(group):
+	layer = get_channel_layer()
+	return await layer.connection(layer.consistent_hash(group)).zcard(layer._group_key(group))
+
+
+async def wait_for_group_size(group, size, timeout= 3):
+	for _ in range(int(timeout / 0.05)):
+		if await group_size(group) == size:
+			return True
+		await asyncio.sleep(0.05)
+
+	return False
+
+
+@pytest.mark.django_db
+class TestConversationMessageCache:
+
+	def test_new_message_is_pushed_and_window_trimmed(self):
+		conversation = baker.make(Conversation)
+		window = ConversationMessageCache(conversation.id, size= 3)
+		Message.objects.rebuild_window(window)
+
+		messages = [
+			baker.make(Message, conversation= conversation, text= str(i)) for i in range(5)
+		]
+		for message in messages:
+			window.push(message)
+
+		floor, window_size, cached = window.read(0, -1)
+
+		assert window_size == 3
+		assert [message.data["id"] for message in cached] == [str(message.id) for message in messages[:1:-1]]
+		assert floor == message_key(messages[2].sent_at, messages[2].id)
+
+	def test_edited_message_is_patched_in_place(self, django_capture_on_commit_callbacks):
+		conversation = baker.make(Conversation)
+		message = baker.make(Message, conversation= conversation, text= "hello")
+		window = ConversationMessageCache(conversation.id)
+		Message.objects.rebuild_window(window)
+
+		with django_capture_on_commit_callbacks(execute= True):
+			message.text = "edited"
+			message.save()
+
+		_, window_size, cached = window.read(0, -1)
+
+		assert window_size == 1
+		assert cached[0].data["text"] == "edited"
+
+	def test_rolled_back_messages_never_reach_the_window(self, django_capture_on_commit_callbacks):
+		conversation = baker.make(Conversation)
+		baker.make(Message, conversation= conversation, text= "first")
+		Message.objects.get_page(conversation.id, 50)
+
+		with django_capture_on_commit_callbacks(execute= True):
+			with pytest.raises(RuntimeError):
+				with transaction.atomic():
+					baker.make(Message, conversation= conversation, text= "ghost")
+					raise RuntimeError()
+
+		page = Message.objects.get_page(conversation.id, 50)
+
+		assert [message.data["text"] for message in page] == ["first"]
+
+	def test_missing_or_corrupt_window_is_rebuilt(self):
+		conversation = baker.make(Conversation)
+		messages = baker.make(Message, conversation= conversation, _quantity= 3)
+		window = ConversationMessageCache(conversation.id)
+
+		assert window.read(0, -1) is None
+		assert len(Message.objects.get_messages(conversation.id, 0, 50)) == 3
+
+		get_redis_client().hset(window.keys[1], str(messages[0].id), b"corrupt")
+
+		assert window.read(0, -1) is None
+		assert len(Message.objects.get_messages(conversation.id, 0, 50)) == 3
+		assert window.read(0, -1)[1] == 3
+
+	def test_pages_past_the_window_come_from_the_database(self):
+		conversation = baker.make(Conversation)
+		for i in range(5):
+			baker.make(Message, conversation= conversation, text= str(i))
+
+		ConversationMessageCache(conversation.id).clear()
+
+		metrics.reset()
+
+		cold_page = Message.objects.get_messages(conversation.id, 2, 2, count= 3)
+
+		assert [message.data["text"] for message in cold_page] == ["2", "1"]
+		assert metrics.snapshot()["message_cache.rebuild"] == 1
+
+		warm_page = Message.objects.get_messages(conversation.id, 2, 2, count= 3)
+
+		assert [message.data["text"] for message in warm_page] == ["2", "1"]
+		assert metrics.snapshot()["message_cache.hit"] == 1
+
+
+	def test_local_cache_is_invalidated_by_writes(self, monkeypatch, django_capture_on_commit_callbacks):
+		monkeypatch.setattr(local_cache, "max_bytes", 1024 * 1024)
+		conversation = baker.make(Conversation)
+		baker.make(Message, conversation= conversation, text= "first")
+
+		Message.objects.get_page(conversation.id, 50)
+		Message.objects.get_page(conversation.id, 50)
+		metrics.reset()
+		Message.objects.get_page(conversation.id, 50)
+
+		assert metrics.snapshot()["message_cache.local_hit"] == 1
+
+		with django_capture_on_commit_callbacks(execute= True):
+			baker.make(Message, conversation= conversation, text= "second")
+		page = Message.objects.get_page(conversation.id, 50)
+
+		assert [message.data["text"] for message in page] == ["second", "first"]
+		assert metrics.snapshot()["message_cache.local_miss"] == 1
+		local_cache.clear()
+
+	def test_local_windows_are_charged_what_they_hold(self, monkeypatch):
+		monkeypatch.setattr(local_cache, "max_bytes", 1024 * 1024)
+		conversation = baker.make(Conversation)
+		baker.make(Message, conversation= conversation, text= "hello" * 20, _quantity= 20)
+
+		pages = [Message.objects.get_messages(conversation.id, offset, 5) for offset in [0, 0, 5, 15]]
+		local = local_cache.get(conversation.id)
+
+		assert [len(page) for page in pages] == [5, 5, 5, 5]
+		assert [message.key for message in pages[3]] == local.keys[4::-1]
+		assert local_cache.size >= sum(
+			sys.getsizeof(key) + sys.getsizeof(payload) for key, payload in zip(local.keys, local.payloads))
+		local_cache.clear()
+
+@pytest.mark.django_db
+class TestMessageCursorPagination:
+
+	def test_cursor_pages_do_not_shift_when_new_messages_arrive(self, django_capture_on_commit_callbacks):
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		baker.make(ConversationMembers, user= user, conversation= conversation)
+		for i in range(5):
+			baker.make(Message, conversation= conversation, text= str(i))
+
+		client.force_authenticate(user)
+		url= f'/api/v1/conversations/{conversation.id}/messages/'
+
+		first_page= client.get(url, {"limit": 2, "before": ""}).data
+		with django_capture_on_commit_callbacks(execute= True):
+			baker.make(Message, conversation= conversation, text= "new")
+		second_page= client.get(first_page["next"]).data
+		third_page= client.get(second_page["next"]).data
+
+		assert [message["text"] for message in first_page["results"]] == ["4", "3"]
+		assert [message["text"] for message in second_page["results"]] == ["2", "1"]
+		assert [message["text"] for message in third_page["results"]] == ["0"]
+		assert third_page["next"] is None
+
+		newer_page= client.get(second_page["previous"]).data
+
+		assert [message["text"] for message in newer_page["results"]] == ["4", "3"]
+		assert newer_page["previous"] is not None
+
+	def test_requests_without_cursor_keep_limit_offset_pages(self):
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		baker.make(ConversationMembers, user= user, conversation= conversation)
+		baker.make(Message, conversation= conversation, _quantity= 5)
+
+		client.force_authenticate(user)
+		page= client.get(f'/api/v1/conversations/{conversation.id}/messages/', {"limit": 2}).data
+
+		assert set(page) == {"count", "next", "previous", "results"}
+		assert len(page["results"]) == 2
+
+	def test_cursor_pages_continue_past_the_cached_window(self):
+		conversation = baker.make(Conversation)
+		for i in range(5):
+			baker.make(Message, conversation= conversation, text= str(i))
+
+		page = Message.objects.get_page(conversation.id, 2, count= 3)
+		older = Message.objects.get_page(conversation.id, 2, before= page[1].key, count= 3)
+
+		assert [message.data["text"] for message in page] == ["4", "3", "2"]
+		assert [message.data["text"] for message in older] == ["2", "1", "0"]
+
+	def test_invalid_cursor_returns_404(self):
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		client.force_authenticate(user)
+
+		response= client.get(
+			f'/api/v1/conversations/{conversation.id}/messages/', {"before": "garbage"})
+
+		assert response.status_code == status.HTTP_404_NOT_FOUND
+
+	def test_cached_page_renders_like_the_serializer_without_per_row_queries(
+		self, django_assert_num_queries):
+
+		client= APIClient()
+		user = baker.make(User)
+		conversation = baker.make(Conversation)
+		baker.make(ConversationMembers, user= user, conversation= conversation)
+		messages = baker.make(Message, conversation= conversation, sent_by= user, _quantity= 10)
+		messages[0].seen_by.add(user)
+
+		client.force_authenticate(user)
+		url= f'/api/v1/conversations/{conversation.id}/messages/'
+		client.get(url)
+
+		with django_assert_num_queries(1):
+			results= client.get(url).data["results"]
+
+		expected= SimpleMessageSerializer(messages[0], context= {"user": user}).data
+
+		assert results[-1] == expected
+
+	def test_only_one_worker_rebuilds_a_cold_window(self, django_assert_num_queries):
+		conversation = baker.make(Conversation)
+		baker.make(Message, conversation= conversation, _quantity= 3)
+		window = ConversationMessageCache(conversation.id)
+
+		token = window.begin_rebuild()
+		assert token is not None
+		assert window.begin_rebuild() is None
+
+		metrics.reset()
+		with django_assert_num_queries(1):
+			page = Message.objects.get_page(conversation.id, 50)
+
+		assert len(page) == 3
+		assert window.read(0, -1) is None
+		assert metrics.snapshot()["message_cache.bypass"] == 1
+		assert len(Message.objects.get_messages(conversation.id, 1, 2)) == 2
+		assert len(Message.objects.get_page(conversation.id, 50, after= page[-1].key)) == 2
+
+		metrics.reset()
+		window.abort_rebuild(token)
+		Message.objects.get_page(conversation.id, 50)
+		Message.objects.get_page(conversation.id, 50)
+
+		stats = metrics.snapshot()
+		assert stats["message_cache.rebuild"] == 1
+		assert stats["message_cache.hit"] == 1
+		assert stats["message_cache.miss"] == 1
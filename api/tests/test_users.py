@@ -1,6 +1,8 @@
 from rest_framework import status 
 from api.models import  User
 from rest_framework.test import APIClient
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 import pytest
 
 
@@ -47,4 +49,44 @@ class TestUserLogin:
 			"password": self.valid_data.get("password")
 		})
 
-		assert response.status_code == status.HTTP_200_OK
\ No newline at end of file
+		assert response.status_code == status.HTTP_200_OK
+
+@pytest.mark.django_db
+class TestCachedAuthentication:
+
+	def test_user_is_resolved_once_and_dropped_when_changed(self, django_assert_num_queries):
+		user = User.objects.create_user(email= "johndoe@gmail.com", password= "user1234", first_name= "John")
+		client= APIClient()
+		client.credentials(HTTP_AUTHORIZATION= f"Bearer {RefreshToken.for_user(user).access_token}")
+
+		assert client.get('/api/v1/me/').status_code == status.HTTP_200_OK
+
+		with django_assert_num_queries(0):
+			assert client.get('/api/v1/me/').data["first_name"] == "John"
+
+		client.patch('/api/v1/me/', {"first_name": "Jack"})
+
+		assert client.get('/api/v1/me/').data["first_name"] == "Jack"
+
+		# Saving the cached user leaves its deferred password alone.
+		user.refresh_from_db()
+		assert user.check_password("user1234")
+
+		user.is_active = False
+		user.save()
+
+		assert client.get('/api/v1/me/').status_code == status.HTTP_401_UNAUTHORIZED
+
+	def test_tokens_without_an_id_skip_the_cache(self, monkeypatch, django_assert_num_queries):
+		monkeypatch.setattr(api_settings, "JTI_CLAIM", None)
+		user = User.objects.create_user(email= "johndoe@gmail.com", password= "user1234")
+		token = RefreshToken.for_user(user).access_token
+		client= APIClient()
+		client.credentials(HTTP_AUTHORIZATION= f"Bearer {token}")
+
+		assert "jti" not in token.payload
+
+		assert client.get('/api/v1/me/').status_code == status.HTTP_200_OK
+
+		with django_assert_num_queries(1):
+			assert client.get('/api/v1/me/').status_code == status.HTTP_200_OK
@@ -1 +1 @@
-from api.utils.authentication import JWTAuthMiddleware
\ No newline at end of file
+from api.utils.authentication import CachedJWTAuthentication, JWTAuthMiddleware
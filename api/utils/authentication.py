@@ -1,15 +1,53 @@
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
 from urllib.parse import parse_qs
 
+from api.cache import AuthenticatedUserCache
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication resolving users through `AuthenticatedUserCache` instead of
+    querying them on every request.
+    """
+
+    def get_user(self, validated_token):
+        # Revoking tokens on password changes needs the password, which isn't cached.
+        if api_settings.CHECK_REVOKE_TOKEN:
+            return super().get_user(validated_token)
+
+        # Users are cached by token, tokens without an id are resolved every time.
+        token_id = validated_token.get(api_settings.JTI_CLAIM)
+        if token_id is None:
+            return super().get_user(validated_token)
+
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        cache = AuthenticatedUserCache(user_id, token_id)
+
+        user = cache.get()
+        if user is None:
+            user = super().get_user(validated_token)
+            cache.set(user)
+
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+
+        return user
+
 
 class JWTAuthMiddleware(BaseMiddleware):
     """Websocket authentication middleware. """
 
     def __init__(self, inner):
         super().__init__(inner)
-        self.authenticator = JWTAuthentication()
+        self.authenticator = CachedJWTAuthentication()
 
     async def __call__(self, scope, receive, send):
         try:
@@ -29,4 +67,4 @@ class JWTAuthMiddleware(BaseMiddleware):
         token = parse_qs(scope["query_string"].decode("utf8")).get("token")[0]
         validated_token = self.authenticator.get_validated_token(token)
 
-        return self.authenticator.get_user(validated_token)
\ No newline at end of file
+        return self.authenticator.get_user(validated_token)
@@ -1,60 +1,373 @@
-import json
+import asyncio
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.utils import timezone
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from rest_framework.exceptions import APIException, NotFound, PermissionDenied, ValidationError
 
 from api.models import User, Conversation, ConversationMembers, Message
+from api.cache import ConversationEventStream
+from api.metrics import metrics
+from api.v1.serializers.conversation import (
+    CreateMessageSerializer, UpdateMessageSerializer, ReadMessagesSerializer)
+from api.v1.utils import (
+    get_unread_counts, get_conversation_members, update_typing,
+    group_add_many, group_discard_many, user_group, update_presence, get_presence,
+    choose_subprotocol, encode_frame, encode_text_frame, convert_text_frame, decode_frame,
+    database_task, DatabaseUnavailable, UserScopedRateThrottle)
 
 class ConversationConsumer(AsyncWebsocketConsumer):
+    # Methods handling each type of frame sent by the client, see `receive`.
+    frame_handlers= {
+        "message.create": "_create_message",
+        "message.update": "_update_message",
+        "message.delete": "_delete_message",
+        "messages.read": "_read_messages",
+        "typing.start": "_start_typing",
+        "typing.stop": "_stop_typing",
+        "typing": "_start_typing",
+        "resume": "_resume",
+        "heartbeat": "_heartbeat",
+        "presence": "_get_presence",
+    }
+
+    # Close code telling the client it fell behind and has to resume its session.
+    RESYNC_CLOSE_CODE= 4008
+
+    # Rate of the messages sent or edited, shared with the views of MessageViewSet.
+    throttle_scope= "messages"
 
     async def connect(self):
+        started_at= time.monotonic()
+
+        # Frames are written to the socket from a queue, see `queue_frame`.
+        self.outbox= asyncio.Queue(maxsize= settings.WEBSOCKET_SEND_QUEUE_SIZE)
+        self.closing= False
+        self.writer= asyncio.ensure_future(self._write_frames())
 
-        await self.accept()
+        # Encoding of the frames both ways, negotiated through the websocket subprotocol.
+        self.protocol= choose_subprotocol(self.scope.get("subprotocols", []))
+        await self.accept(subprotocol= self.protocol)
 
         self.user: User= self.scope["user"]
+        # When the connection last reported typing, by conversation.
+        self.typing= {}
     
-        conversations = await self._get_conversations_details(self.user)
-        for conversation_id in conversations:
-            await self.channel_layer.group_add(conversation_id, self.channel_name)
+        try:
+            conversations = await self._get_conversations_details(self.user)
+        except DatabaseUnavailable:
+            # Try again later: the client reconnects once the burst is over.
+            return await self.close(code= 1013)
+
+        # Groups the connection is in, left on disconnect without going to the database.
+        # Routed by user, events of every conversation come through the user's group.
+        self.subscriptions= {user_group(self.user.id)}
+        if settings.CONVERSATION_ROUTING != "user":
+            self.subscriptions.update(conversations)
+
+        await group_add_many(self.channel_layer, self.subscriptions, self.channel_name)
 
         data= {
             "type": "user.connected",
             "message": conversations
         }
 
-        return await self.channel_layer.send(self.channel_name, {"type": "send.message", "message": data})
+        await self.channel_layer.send(self.channel_name, {"type": "send.message", "message": data})
+        await self._heartbeat()
+
+        metrics.observe("websocket.connect_ms", (time.monotonic() - started_at) * 1000)
 
 
     async def disconnect(self, close_code):
-        conversations = self._get_conversations_details(self.user)
-        for conversation_id in conversations:
-            await self.channel_layer.group_discard(conversation_id, self.channel_name)
+        if hasattr(self, "writer"):
+            self.writer.cancel()
+
+        if not hasattr(self, "subscriptions"):
+            return
+
+        await group_discard_many(self.channel_layer, self.subscriptions, self.channel_name)
+        # Cleanup can't be turned down by the database executor, see `database_task`.
+        await database_sync_to_async(update_presence)(self.user.id, self.channel_name, False)
+        await database_sync_to_async(self._clear_typing)()
 
     
+    async def update_subscriptions(self, event):
+        """ Follows the membership changes of the user, see `update_member_subscriptions`. """
+
+        subscribe= set(event["subscribe"]) - self.subscriptions
+        unsubscribe= set(event["unsubscribe"]) & self.subscriptions
+
+        self.subscriptions |= subscribe
+        self.subscriptions -= unsubscribe
+
+        await group_add_many(self.channel_layer, subscribe, self.channel_name)
+        await group_discard_many(self.channel_layer, unsubscribe, self.channel_name)
+
     async def send_message(self, event):
-        return await self.send(text_data= json.dumps({"message": event["message"]}))
+        """ Broadcast events come with their frame already encoded, see `broadcast_conversation_event`. """
+
+        if "text" in event:
+            frame= encode_text_frame(event["text"], self.protocol)
+        else:
+            frame= encode_frame({"message": event["message"]}, self.protocol)
+
+        await self.queue_frame(frame, droppable= event.get("droppable", False))
+
+    async def queue_frame(self, frame, droppable= False):
+        """
+        Queues a frame for the socket without waiting on the client, so that a slow one
+        can't hold up the channel layer. Past half the queue, droppable frames (typing,
+        presence) are dropped; once it is full the connection is closed with
+        RESYNC_CLOSE_CODE and the client resumes its session.
+        """
+
+        if self.closing:
+            return
+
+        depth= self.outbox.qsize()
+        metrics.observe("websocket.send_queue_depth", depth)
+
+        if droppable and depth >= self.outbox.maxsize // 2:
+            return metrics.incr("websocket.dropped_frames")
+
+        try:
+            self.outbox.put_nowait(frame)
+        except asyncio.QueueFull:
+            metrics.incr("websocket.overflow_closes")
+            self.closing= True
+            await self.close(code= self.RESYNC_CLOSE_CODE)
+
+    async def _write_frames(self):
+        while True:
+            frame= await self.outbox.get()
+            await self.send(**frame)
+
+
+    async def receive(self, text_data= None, bytes_data= None):
+        """
+        Handles the frames sent by the client, shaped as
+        {"type": ..., "id": <correlation id>, "conversation": <id>, ...}.
+        Frames carrying an id are answered with an ack holding that id, failures always
+        with an error frame.
+        """
+
+        try:
+            frame= decode_frame(text_data, bytes_data, self.protocol)
+            handler= getattr(self, self.frame_handlers[frame["type"]])
+        except (TypeError, ValueError, KeyError):
+            return await self.send_message(
+                {"message": {"type": "error", "id": None, "message": {"detail": "Invalid frame."}}})
+
+        try:
+            data= await handler(frame)
+        except APIException as error:
+            return await self.send_message(
+                {"message": {"type": "error", "id": frame.get("id"), "message": error.detail}})
+
+        if frame.get("id") is not None:
+            await self.send_message({"message": {"type": "ack", "id": frame["id"], "message": data}})
     
-    @database_sync_to_async
+    @database_task
     def _get_conversations_details(self, user):
-        """ Gets the details of all conversation a user belongs. """
+        """
+        Gets the details of all conversation a user belongs, in a constant number of
+        queries whatever the number of conversations.
+        """
         
         data= {}
 
-        conversations = Conversation.objects.filter(members= self.user)
+        conversations = list(Conversation.objects.filter(members= user).select_related("created_by"))
+        unreads= get_unread_counts(user)
+        seqs= ConversationEventStream.current(conversation.id for conversation in conversations)
 
         for conversation in conversations:
-            joined_at = ConversationMembers.objects.get(
-                user= self.user, 
-                conversation= conversation
-            ).joined_at
+            data[str(conversation.id)] = {
+                "unreads": unreads.get(str(conversation.id), 0),
+                "seq": seqs[str(conversation.id)],
+                **conversation.to_dict()
+            }
+
+
+        return data
+
+
+    def _get_conversation_id(self, frame):
+        """ Conversation a frame is about, provided the user is one of its members. """
+
+        try:
+            conversation_id= uuid.UUID(str(frame.get("conversation")))
+        except ValueError:
+            raise ValidationError({"conversation": "Invalid conversation."})
+
+        if self.user.id not in get_conversation_members(conversation_id):
+            raise PermissionDenied("You are not a member of this conversation.")
+
+        return conversation_id
+
+    def _get_message(self, frame, conversation_id):
+        try:
+            return Message.objects.select_related("sent_by").get(
+                id= frame.get("message"), conversation_id= conversation_id)
+        except (Message.DoesNotExist, DjangoValidationError):
+            raise NotFound("Message not found.")
+
+    def _throttle_messages(self):
+        UserScopedRateThrottle(self.throttle_scope).check(self.user)
+
+    @database_task
+    @transaction.atomic
+    def _create_message(self, frame):
+        self._throttle_messages()
+        serializer= CreateMessageSerializer(
+            data= frame.get("data"),
+            context= {"user": self.user, "conversation_id": self._get_conversation_id(frame)}
+        )
+        serializer.is_valid(raise_exception= True)
+        serializer.save()
+
+        return serializer.data
+
+    @database_task
+    @transaction.atomic
+    def _update_message(self, frame):
+        self._throttle_messages()
+        message= self._get_message(frame, self._get_conversation_id(frame))
+
+        if message.sent_by_id != self.user.id:
+            raise PermissionDenied("You can only edit your own messages.")
+
+        if message.deleted_at:
+            raise ValidationError({"detail": "Update not allowed on deleted message."})
+
+        serializer= UpdateMessageSerializer(
+            message,
+            data= frame.get("data"),
+            partial= True,
+            context= {"user": self.user, "message_type": message.message_type}
+        )
+        serializer.is_valid(raise_exception= True)
+        serializer.save(updated_at= timezone.now())
+
+        return serializer.data
+
+    @database_task
+    @transaction.atomic
+    def _delete_message(self, frame):
+        conversation_id= self._get_conversation_id(frame)
+        message= self._get_message(frame, conversation_id)
+
+        if message.sent_by_id != self.user.id and not ConversationMembers.objects.filter(
+            user= self.user, conversation_id= conversation_id, is_admin= True).exists():
+            raise PermissionDenied("You can only delete your own messages.")
+
+        if message.deleted_at:
+            raise ValidationError({"detail": "Delete not allowed on deleted message."})
+
+        message.deleted_at= timezone.now()
+        message.save()
+
+        return {"id": str(message.id)}
+
+    @database_task
+    @transaction.atomic
+    def _read_messages(self, frame):
+        serializer= ReadMessagesSerializer(
+            data= frame.get("data"),
+            context= {"user": self.user, "conversation": self._get_conversation_id(frame)}
+        )
+        serializer.is_valid(raise_exception= True)
+        serializer.save()
+
+    async def _start_typing(self, frame):
+        # Typing frames come as fast as keys are pressed, a connection already typing
+        # only has to say so again now and then to keep it.
+        reported_at= self.typing.get(str(frame.get("conversation")))
+        if reported_at and time.monotonic() - reported_at < settings.TYPING_TIMEOUT / 3:
+            return
+
+        await self._update_typing(frame, True)
+
+    async def _stop_typing(self, frame):
+        await self._update_typing(frame, False)
+
+    @database_task
+    def _update_typing(self, frame, typing):
+        conversation_id= self._get_conversation_id(frame)
+
+        update_typing(self.user.id, conversation_id, typing)
+
+        if typing:
+            self.typing[str(conversation_id)]= time.monotonic()
+        else:
+            self.typing.pop(str(conversation_id), None)
+
+    def _clear_typing(self):
+        for conversation_id in self.typing:
+            update_typing(self.user.id, conversation_id, False)
+
+    async def _heartbeat(self, frame= None):
+        """ Keeps the connection online, clients send one at least every PRESENCE_TIMEOUT seconds. """
+
+        # Like disconnecting, not subject to the admission control of the database executor.
+        await database_sync_to_async(update_presence)(self.user.id, self.channel_name, True)
+
+    @database_task
+    def _get_presence(self, frame):
+        return get_presence(self._get_conversation_id(frame))
+
+    async def _resume(self, frame):
+        """
+        Sends the events the client missed, given the last sequence number it saw in each
+        conversation as {"data": {<conversation id>: <seq>}}. Conversations too far
+        behind get a resync frame instead and have to be reloaded. Conversations the
+        user is no longer a member of are skipped and listed as `removed` in the reply.
+        Events broadcast meanwhile may be received twice, clients drop those whose seq
+        they have already seen.
+        """
+
+        missed, resync, removed= await self._get_missed_events(frame)
+
+        # Waits on the queue rather than overflowing it: the client asked for these.
+        for text in missed:
+            await self.outbox.put(convert_text_frame(text, self.protocol))
+
+        metrics.incr("websocket.replayed_events", len(missed))
+        metrics.incr("websocket.resyncs", len(resync))
+
+        for conversation_id in resync:
+            await self.send_message(
+                {"message": {"type": "resync", "message": {"conversation": conversation_id}}})
+
+        return {"replayed": len(missed), "resync": resync, "removed": removed}
+
+    @database_task
+    def _get_missed_events(self, frame):
+        seqs= frame.get("data")
+        if not isinstance(seqs, dict) or not all(
+            isinstance(seq, int) and seq >= 0 for seq in seqs.values()):
+            raise ValidationError({"data": "Expected the last seen seq of every conversation."})
+
+        missed, resync, removed= [], [], []
+
+        for conversation, seq in seqs.items():
+            try:
+                conversation_id= self._get_conversation_id({"conversation": conversation})
+            except PermissionDenied:
+                removed.append(conversation)
+                continue
 
-            unreads= Message.objects.filter(
-                conversation= conversation, 
-                sent_at__gte= joined_at
-                ).exclude(
-                    seen_by= self.user
-                ).count()
+            events= ConversationEventStream(conversation_id).read_after(seq)
 
-            data[str(conversation.id)] = {"unreads": unreads, **conversation.to_dict()}
+            if events is None:
+                resync.append(str(conversation_id))
+            else:
+                missed.extend(events)
 
+        return missed, resync, removed
 
-        return data
\ No newline at end of file
@@ -1,8 +1,9 @@
 from rest_framework import serializers
 
-from api.models import User, Conversation, Message, ConversationMembers, MessageViewers
+from api.models import User, Conversation, Message, ConversationMembers
 from api.enums import MessageTypeEnum
 from api.v1.serializers import UserRetrieveSerializer
+from api.v1.utils import advance_read_cursor, get_unread_counts, mark_messages_read
 
 
 class CreateConversationSerializer(serializers.ModelSerializer):
@@ -36,20 +37,33 @@ class SimpleConversationSerializer(serializers.ModelSerializer):
 
     
     def get_number_of_unreads(self, instance: Conversation):
-        user= self.context.get("request").user
+        if "unreads" not in self.context:
+            self.context["unreads"]= get_unread_counts(self.context.get("request").user)
 
-        try:
-            joined_at = ConversationMembers.objects.get(
-                user= user, conversation= instance).joined_at
-        except ConversationMembers.DoesNotExist:
-            return 0
-
-        return Message.objects.filter(
-            conversation= instance, 
-            sent_at__gte= joined_at
-            ).exclude(
-                seen_by=user
-            ).count()
+        return self.context["unreads"].get(str(instance.id), 0)
+
+class InboxConversationSerializer(serializers.ModelSerializer):
+    """Conversation of the user as listed in the inbox, read through their membership"""
+
+    id= serializers.UUIDField(source= "conversation_id")
+    name= serializers.CharField(source= "conversation.name")
+    is_private= serializers.BooleanField(source= "conversation.is_private")
+    number_of_unreads= serializers.SerializerMethodField()
+    last_message= serializers.JSONField(source= "conversation.last_message")
+    message_count= serializers.IntegerField(source= "conversation.message_count")
+
+    class Meta:
+        model= ConversationMembers
+        fields= [
+            "id", "name", "is_private", "number_of_unreads",
+            "last_message_at", "last_message", "message_count"
+        ]
+
+    def get_number_of_unreads(self, instance: ConversationMembers):
+        if "unreads" not in self.context:
+            self.context["unreads"]= get_unread_counts(self.context.get("request").user)
+
+        return self.context["unreads"].get(str(instance.conversation_id), 0)
 
 class ConversationSerializer(serializers.ModelSerializer):
     created_by= UserRetrieveSerializer()
@@ -68,15 +82,56 @@ class AddORemoveMemberConversationSerializer(serializers.Serializer):
     
 
 class MarkMessageReadSerializer(serializers.Serializer):
-    message= serializers.PrimaryKeyRelatedField(queryset= Message.objects.all())
+    message= serializers.UUIDField()
     seen_at= serializers.DateTimeField()
 
+
+class ReadMessagesSerializer(serializers.Serializer):
+    """Marks the given messages of a conversation read, or moves the read cursor up to `up_to`"""
+
+    up_to= serializers.UUIDField(required= False)
+    messages= serializers.ListField(
+        child= serializers.UUIDField(), required= False, allow_empty= False, max_length= 1000)
+
+    def validate(self, attrs):
+        if ("up_to" in attrs) == ("messages" in attrs):
+            raise serializers.ValidationError(
+                "Either up_to or messages must be provided.")
+
+        conversation= self.context.get("conversation")
+        messages= Message.objects.filter(conversation= conversation).only(
+            "id", "conversation_id", "sent_by_id", "sent_at")
+
+        if "messages" in attrs:
+            ids= set(attrs["messages"])
+            attrs["messages"]= list(messages.filter(id__in= ids))
+
+            if len(attrs["messages"]) != len(ids):
+                missing= ids - {message.id for message in attrs["messages"]}
+                raise serializers.ValidationError(
+                    {"messages": [f"Message {id} is not in the conversation." for id in missing]})
+
+            return attrs
+
+        try:
+            last= messages.get(id= attrs["up_to"])
+        except Message.DoesNotExist:
+            raise serializers.ValidationError({"up_to": "Message is not in the conversation."})
+
+        # The read cursor covers the messages before `last`: only `last` gets a receipt,
+        # however many messages the member is behind.
+        attrs["messages"]= [last]
+
+        return attrs
+
     def create(self, validated_data):
-        user= self.context.get("user")
-        return MessageViewers.objects.create(user= user, **validated_data)
+        mark_messages_read(self.context.get("user"), validated_data["messages"])
+        return validated_data
     
 
 class SimpleMessageSerializer(serializers.ModelSerializer):
+    conversation= serializers.PrimaryKeyRelatedField(
+        read_only= True, pk_field= serializers.UUIDField(format= "hex_verbose"))
     sent_by= UserRetrieveSerializer()
     is_mine= serializers.SerializerMethodField()
     class Meta:
@@ -144,7 +199,7 @@ class CreateMessageSerializer(serializers.ModelSerializer):
             conversation_id= conversation_id, 
             **validated_data
         )
-        message.seen_by.add(user)
+        advance_read_cursor(user, message)
 
         return message
 
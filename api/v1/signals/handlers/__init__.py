@@ -1 +1,2 @@
-from api.v1.signals.handlers.conversation import handle_deleted_message, handle_saved_message, handle_new_conversation_event
\ No newline at end of file
+from api.v1.signals.handlers.conversation import handle_deleted_message, handle_saved_message, handle_new_conversation_event
+from api.v1.signals.handlers.user import handle_changed_user
@@ -1,8 +1,16 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, m2m_changed
 
-from api.models import Message
-from api.v1.utils import update_conversation_cache, broadcast_conversation_event
+from api.models import Message, Conversation, ConversationMembers
+from api.cache import ConversationMembersCache, UnreadCounters
+from api.v1.utils import (
+        update_conversation_cache, remove_from_conversation_cache, count_new_message,
+        update_member_subscriptions, broadcast_conversation_event, record_conversation_activity,
+        refresh_last_message, forget_conversation_message)
 from api.v1.signals import new_conversation_event
 from api.v1.serializers.conversation import SimpleMessageSerializer
 
@@ -10,22 +18,118 @@ from api.v1.serializers.conversation import SimpleMessageSerializer
 @receiver(post_save, sender= Message)
 def handle_saved_message(sender, **kwargs):
         message: Message= kwargs["instance"]
-        update_conversation_cache(message.conversation.id, 500)
+        update_conversation_cache(message, created= kwargs["created"])
 
         if kwargs["created"]:
+                record_conversation_activity(message)
+                count_new_message(message)
                 broadcast_conversation_event(
-                        message.conversation.id,
+                        message.conversation_id,
                         {
                                 "type": "new.message",
                                 "message": SimpleMessageSerializer(message).data
                         })
+        else:
+                event= get_message_change_event(message)
+                if event:
+                        refresh_last_message(message)
+                        broadcast_conversation_event(message.conversation_id, event)
+
+        message.remember_values()
+
+
+def get_message_change_event(message: Message):
+        """
+        Delta event of an edited or deleted message, holding only its ids and the fields
+        that changed, rendered as by SimpleMessageSerializer. None when nothing did.
+        """
+
+        changed= message.changed_fields()
+        data= {"id": str(message.id), "conversation": str(message.conversation_id)}
 
+        if "deleted_at" in changed and message.deleted_at:
+                fields= SimpleMessageSerializer().fields
+                return {
+                        "type": "message.deleted",
+                        "message": {**data, "deleted_at": fields["deleted_at"].to_representation(message.deleted_at)}
+                }
+
+        if not changed:
+                return None
+
+        fields= SimpleMessageSerializer().fields
+        for name in changed:
+                value= getattr(message, name)
+                data[name]= None if value is None else fields[name].to_representation(value)
+
+        return {"type": "message.updated", "message": data}
 
 
 @receiver(post_delete, sender= Message)
 def handle_deleted_message(sender, **kwargs):
         message: Message= kwargs["instance"]
-        update_conversation_cache(message.conversation.id, 500)
+        remove_from_conversation_cache(message)
+        forget_conversation_message(message)
+        # Once committed, or counters refilled in the meantime would still count the message.
+        user_ids= list(
+                ConversationMembers.objects.filter(
+                        conversation_id= message.conversation_id
+                        ).values_list("user_id", flat= True)
+        )
+        transaction.on_commit(partial(UnreadCounters.invalidate, user_ids))
+
+
+
+@receiver(m2m_changed, sender= Conversation.members.through)
+def handle_membership_change(sender, **kwargs):
+        """
+        Keeps the cached members of conversations up to date. Unread counters of users
+        joining or leaving a conversation are refilled on their next read, and their live
+        connections follow the change.
+        """
+
+        action= kwargs["action"]
+        instance= kwargs["instance"]
+
+        if action not in ["post_add", "post_remove", "pre_clear"]:
+                return
+
+        if kwargs["reverse"]:
+                user_ids= [instance.pk]
+                conversation_ids= list(
+                        kwargs["pk_set"] if action != "pre_clear"
+                        else instance.conversations.values_list("id", flat= True)
+                )
+        else:
+                user_ids= list(
+                        kwargs["pk_set"] if action != "pre_clear"
+                        else instance.members.values_list("id", flat= True)
+                )
+                conversation_ids= [instance.pk]
+
+        UnreadCounters.invalidate(user_ids)
+
+        if action == "post_add":
+                # New members list the conversation by its last message, not by when they joined.
+                ConversationMembers.objects.filter(
+                        user_id__in= user_ids, conversation_id__in= conversation_ids
+                ).update(last_message_at= Subquery(
+                        Conversation.objects.filter(id= OuterRef("conversation_id")).values("last_message_at")[:1]
+                ))
+
+        for conversation_id in conversation_ids:
+                if action == "post_add":
+                        ConversationMembersCache(conversation_id).add(user_ids)
+                elif action == "post_remove":
+                        ConversationMembersCache(conversation_id).remove(user_ids)
+                else:
+                        ConversationMembersCache(conversation_id).clear()
+
+        for user_id in user_ids:
+                if action == "post_add":
+                        update_member_subscriptions(user_id, subscribe= conversation_ids)
+                else:
+                        update_member_subscriptions(user_id, unsubscribe= conversation_ids)
 
 
 
@@ -0,0 +1,13 @@
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+
+from api.models import User
+from api.cache import AuthenticatedUserCache
+
+
+@receiver(post_save, sender= User)
+@receiver(post_delete, sender= User)
+def handle_changed_user(sender, **kwargs):
+        """ Updates, deactivations and deletions (e.g. through UserViewSet) drop the cached user. """
+
+        AuthenticatedUserCache.invalidate(kwargs["instance"].id)
@@ -1,2 +1,17 @@
-from api.v1.utils.pagination import CustomLimitOffsetPagination
-from api.v1.utils.conversation import update_conversation_cache, broadcast_conversation_event
\ No newline at end of file
+from api.v1.utils.pagination import CustomLimitOffsetPagination, MessageCursorPagination, InboxCursorPagination
+from api.v1.utils.channels import group_add_many, group_discard_many, group_send_many
+from api.v1.utils.database import DatabaseUnavailable, DatabaseExecutor, database_task
+from api.v1.utils.frames import (
+	SUBPROTOCOLS, choose_subprotocol, encode_frame, encode_text_frame, convert_text_frame,
+	decode_frame)
+from api.v1.utils.conversation import (
+	update_conversation_cache, remove_from_conversation_cache, advance_read_cursor,
+	message_snapshot, record_conversation_activity, refresh_last_message, forget_conversation_message,
+	mark_messages_read, broadcast_read_receipt, update_typing, count_new_message, get_unread_counts,
+	reconcile_unreads, render_cached_messages, get_conversation_members, user_group,
+	update_member_subscriptions, encode_event, broadcast_conversation_event, prepare_conversation_event,
+	conversation_groups, wake_outbox_dispatcher, OUTBOX_WAKEUP_KEY)
+from api.v1.utils.outbox import dispatch_outbox
+from api.v1.utils.throttling import UserScopedRateThrottle
+from api.v1.utils.scheduler import FlushScheduler, scheduler
+from api.v1.utils.presence import update_presence, broadcast_presence, sweep_presence, get_presence
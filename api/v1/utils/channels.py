@@ -0,0 +1,72 @@
+import asyncio
+import time
+from collections import defaultdict
+from importlib.metadata import version
+
+from channels_redis.core import RedisChannelLayer
+
+
+# `_pipeline_by_shard` relies on private parts of channels_redis (`consistent_hash`,
+# `connection`, `_group_key`) and repeats the commands of its `group_add`. It is only
+# used on the versions it was checked against, others get concurrent `group_add` calls.
+PIPELINED_CHANNELS_REDIS_VERSIONS = ("4.2.",)
+CHANNELS_REDIS_VERSION = version("channels-redis")
+
+
+def can_pipeline(channel_layer) -> bool:
+	""" Whether groups of `channel_layer` can be joined and left through `_pipeline_by_shard`. """
+
+	return (
+		isinstance(channel_layer, RedisChannelLayer)
+		and CHANNELS_REDIS_VERSION.startswith(PIPELINED_CHANNELS_REDIS_VERSIONS)
+	)
+
+
+async def group_add_many(channel_layer, groups, channel):
+	"""
+	Adds `channel` to every one of `groups`. On the Redis channel layer this takes one
+	pipelined round trip per shard rather than two per group (see `can_pipeline`),
+	other layers have their `group_add` calls issued concurrently.
+	"""
+
+	if not can_pipeline(channel_layer):
+		return await asyncio.gather(*(channel_layer.group_add(group, channel) for group in groups))
+
+	joined_at = time.time()
+
+	def add(pipe, group_key):
+		pipe.zadd(group_key, {channel: joined_at})
+		pipe.expire(group_key, channel_layer.group_expiry)
+
+	await _pipeline_by_shard(channel_layer, groups, add)
+
+
+async def group_discard_many(channel_layer, groups, channel):
+	""" Removes `channel` from every one of `groups`, the same way as `group_add_many`. """
+
+	if not can_pipeline(channel_layer):
+		return await asyncio.gather(*(channel_layer.group_discard(group, channel) for group in groups))
+
+	await _pipeline_by_shard(
+		channel_layer, groups, lambda pipe, group_key: pipe.zrem(group_key, channel))
+
+
+async def group_send_many(channel_layer, groups, message):
+	""" Sends `message` to every one of `groups` concurrently. """
+
+	await asyncio.gather(*(channel_layer.group_send(group, message) for group in groups))
+
+
+async def _pipeline_by_shard(channel_layer: RedisChannelLayer, groups, command):
+	shards = defaultdict(list)
+	for group in groups:
+		assert channel_layer.valid_group_name(group), "Group name not valid"
+		shards[channel_layer.consistent_hash(group)].append(group)
+
+	async def execute(index, groups):
+		async with channel_layer.connection(index).pipeline(transaction= False) as pipe:
+			for group in groups:
+				command(pipe, channel_layer._group_key(group))
+			await pipe.execute()
+
+	await asyncio.gather(*(execute(index, groups) for index, groups in shards.items()))
@@ -1,39 +1,397 @@
-from django.core.cache import cache
+import json
+from copy import copy
+from functools import partial
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
-from api.models import Message
+from api.models import Conversation, ConversationMembers, Message, MessageViewers, OutboxEvent
+from api.cache import (
+	ConversationMessageCache, ConversationMembersCache, CachedMessage, ReadReceiptBuffer, UnreadCounters,
+	ConversationEventStream, TypingIndicators, get_redis_client)
+from api.metrics import metrics
+from api.v1.utils.channels import group_send_many
+from api.v1.utils.scheduler import scheduler
+
+
+# List `dispatch_outbox` waits on between batches.
+OUTBOX_WAKEUP_KEY = "outbox:wakeup"
+
+# Characters of the text of the last message kept in the snapshot of conversations.
+LAST_MESSAGE_PREVIEW_LENGTH = 100
+
+
+def update_conversation_cache(message: Message, created= False):
+	"""
+	Applies a saved message to the cached window of its conversation once the
+	transaction commits, so that rolled back writes never reach the window and
+	rebuilds only have to be voided by committed ones. New messages are pushed
+	(trimming the oldest one), edits and soft deletes are patched in place.
+	"""
+
+	window = ConversationMessageCache(message.conversation_id)
+
+	# A copy, the message may change or lose its pk by the time the transaction commits.
+	transaction.on_commit(partial(window.push if created else window.patch, copy(message)))
+
+
+def remove_from_conversation_cache(message: Message):
+	""" Drops a deleted message from the cached window of its conversation, once committed. """
+
+	window = ConversationMessageCache(message.conversation_id)
+
+	transaction.on_commit(partial(window.remove, copy(message)))
+
+
+def message_snapshot(message: Message) -> dict:
+	""" What the inbox shows of the last message of a conversation. """
 
-def update_conversation_cache(conversation_id, count):
+	deleted = message.deleted_at is not None
+
+	return {
+		"id": str(message.id),
+		"sent_by": message.sent_by_id,
+		"message_type": message.message_type,
+		"text": None if deleted or message.text is None else message.text[:LAST_MESSAGE_PREVIEW_LENGTH],
+		"media_url": None if deleted else message.media_url,
+		"sent_at": message.sent_at,
+		"deleted": deleted,
+	}
+
+
+def record_conversation_activity(message: Message):
 	"""
-	Updates the cache with the most recent `count` messages in the conversation.
-	Usuall called after database operations on  a conversation.
+	Counts a new message in its conversation and makes it the last one, unless a later
+	message already is, and moves the inbox of every member to it. Done once the
+	transaction commits, as short statements of their own rather than row locks held
+	for the whole request.
 	"""
 
-	cache_key = f"messages:conversation:{conversation_id}"
-	cached_messages = list(
-		Message.objects.filter(
-			conversation_id= conversation_id
-			).order_by('-sent_at')[:count]
+	def record(conversation_id, sent_at, snapshot):
+		latest = Conversation.objects.filter(
+			id= conversation_id, last_message_at__lte= sent_at
+		).update(
+			last_message_at= sent_at,
+			last_message= snapshot,
+			message_count= F("message_count") + 1
 		)
-			
-	cache.set(cache_key, cached_messages, timeout= 60*60*24)
 
-	return cached_messages
+		if not latest:
+			return Conversation.objects.filter(id= conversation_id).update(message_count= F("message_count") + 1)
+
+		ConversationMembers.objects.filter(
+			conversation_id= conversation_id, last_message_at__lt= sent_at
+		).update(last_message_at= sent_at)
+
+	transaction.on_commit(
+		partial(record, message.conversation_id, message.sent_at, message_snapshot(message)))
+
+
+def refresh_last_message(message: Message):
+	""" Updates the snapshot of an edited or soft deleted message when it is the last one, once committed. """
+
+	def refresh(conversation_id, message_id, snapshot):
+		Conversation.objects.filter(
+			id= conversation_id, last_message__id= message_id
+		).update(last_message= snapshot)
 
+	transaction.on_commit(
+		partial(refresh, message.conversation_id, str(message.id), message_snapshot(message)))
 
 
-def broadcast_conversation_event(conversation_id, event):
+def forget_conversation_message(message: Message):
+	"""
+	Uncounts a deleted message once committed, the one before it becoming the last
+	message if it was.
 	"""
-	Broadcast events from the application to the channels.
 
-	'event' should contain only type and message key.
+	def forget(conversation_id, message_id):
+		Conversation.objects.filter(id= conversation_id).update(
+			message_count= Greatest(F("message_count") - 1, 0))
+
+		if not Conversation.objects.filter(id= conversation_id, last_message__id= message_id).exists():
+			return
+
+		previous = Message.objects.filter(conversation_id= conversation_id).latest_first().first()
+		if previous is None:
+			return Conversation.objects.filter(id= conversation_id).update(last_message= None)
+
+		Conversation.objects.filter(id= conversation_id).update(
+			last_message_at= previous.sent_at, last_message= message_snapshot(previous))
+		ConversationMembers.objects.filter(conversation_id= conversation_id).update(
+			last_message_at= previous.sent_at)
+
+	transaction.on_commit(partial(forget, message.conversation_id, str(message.id)))
+
+
+def advance_read_cursor(user, message: Message):
+	"""
+	Moves the user's read cursor in the conversation of `message` up to it.
+	Cursors only move forward, marking an older message read leaves them as they are.
+	"""
+
+	advanced = ConversationMembers.objects.filter(
+		Q(last_read_at__isnull= True) | Q(last_read_at__lt= message.sent_at),
+		user= user,
+		conversation_id= message.conversation_id,
+	).update(last_read_at= message.sent_at, last_read_message= message)
+
+	if advanced:
+		member = ConversationMembers.objects.get(user= user, conversation_id= message.conversation_id)
+		UnreadCounters(user.id).set(message.conversation_id, Message.objects.unread_by(member).count())
+
+	return advanced
+
+
+def mark_messages_read(user, messages: list[Message]):
+	"""
+	Records read receipts of the user for `messages` with a single insert and moves
+	their read cursor up to the latest one. Receipts that already exist are left as
+	they are, so marking a message read again is harmless.
+	"""
+
+	if not messages:
+		return
+
+	MessageViewers.objects.bulk_create(
+		[
+			MessageViewers(user= user, message= message)
+			for message in messages if message.sent_by_id != user.id
+		],
+		ignore_conflicts= True
+	)
+
+	latest = max(messages, key= lambda message: (message.sent_at, message.id))
+	if advance_read_cursor(user, latest):
+		broadcast_read_receipt(user, latest)
+
+
+def broadcast_read_receipt(user, message: Message):
+	"""
+	Lets the conversation know the user read up to `message`. Receipts are coalesced
+	over READ_RECEIPT_COALESCE_WINDOW: the first one opens the window and the receipts
+	gathered by the time it closes go out as a single `messages.seen` event.
+	"""
+
+	window = settings.READ_RECEIPT_COALESCE_WINDOW
+
+	if not ReadReceiptBuffer(message.conversation_id).add(user.id, message, window):
+		return
+
+	if not window:
+		return flush_read_receipts(message.conversation_id)
+
+	scheduler.call_later(window, flush_read_receipts, message.conversation_id)
+
+
+def flush_read_receipts(conversation_id):
+	receipts = ReadReceiptBuffer(conversation_id).drain()
+	if receipts:
+		broadcast_conversation_event(conversation_id, {"type": "messages.seen", "message": receipts})
+
+
+def update_typing(user_id, conversation_id, typing: bool):
+	"""
+	Records that the user started or stopped typing in the conversation. Changes are
+	coalesced over TYPING_BROADCAST_INTERVAL: the first one opens the window and the
+	users typing when it closes go out as a single `users.typing` event, so fan-out
+	stays at one event per interval however busy the room.
+	"""
+
+	window = settings.TYPING_BROADCAST_INTERVAL
+
+	if not TypingIndicators(conversation_id, settings.TYPING_TIMEOUT).update(user_id, typing, window):
+		return
+
+	if not window:
+		return flush_typing(conversation_id)
+
+	scheduler.call_later(window, flush_typing, conversation_id)
+
+
+def flush_typing(conversation_id):
+	users, count = TypingIndicators(conversation_id, settings.TYPING_TIMEOUT).read(settings.TYPING_MAX_USERS)
+
+	broadcast_conversation_event(
+		conversation_id,
+		{
+			"type": "users.typing",
+			"message": {"conversation": str(conversation_id), "users": users, "count": count}
+		},
+		replayable= False)
+
+
+def count_new_message(message: Message):
+	"""
+	Bumps the unread count of the conversation of a new message for everyone but its
+	sender, once the transaction commits so that rolled back messages aren't counted.
+	"""
+
+	def increment(conversation_id, sent_by_id):
+		user_ids = get_conversation_members(conversation_id) - {sent_by_id}
+		UnreadCounters.increment(conversation_id, user_ids)
+
+	transaction.on_commit(partial(increment, message.conversation_id, message.sent_by_id))
+
+
+def get_unread_counts(user) -> dict:
+	"""
+	Unread counts of every conversation of the user, by conversation id. They come
+	from the user's counters, which are reconciled with the database when missing.
+	"""
+
+	counts = UnreadCounters(user.id).read()
+	if counts is None:
+		counts = reconcile_unreads(user)
+
+	return counts
+
+
+def reconcile_unreads(user) -> dict:
+	""" Recounts the unread messages of the user from the database and stores them as their counters. """
+
+	counts = {
+		str(conversation_id): unreads
+		for conversation_id, unreads in Conversation.objects.filter(
+			members= user
+			).with_member_details(user).values_list("id", "number_of_unreads")
+	}
+	UnreadCounters(user.id).fill(counts)
+	metrics.incr("unreads.reconcile")
+
+	return counts
+
+
+def render_cached_messages(messages: list[CachedMessage], user):
 	"""
+	Renders cached messages in the shape of SimpleMessageSerializer.
+	Reader dependent fields are filled in here, `seen_by` with a single query for the page.
+	"""
+
+	seen_by= {message.data["id"]: [] for message in messages}
+	viewers= MessageViewers.objects.filter(
+		message_id__in= seen_by.keys()
+		).values_list("message_id", "user_id")
+
+	for message_id, user_id in viewers:
+		seen_by[str(message_id)].append(user_id)
+
+	return [
+		{
+			**message.data,
+			"is_mine": bool(message.data["sent_by"]) and message.data["sent_by"]["id"] == user.id,
+			"seen_by": seen_by[message.data["id"]],
+		}
+		for message in messages
+	]
+
+
+def get_conversation_members(conversation_id) -> set:
+	""" Ids of the members of a conversation, read from their cached set or the database. """
+
+	members = ConversationMembersCache(conversation_id)
+
+	user_ids = members.read()
+	if user_ids is None:
+		user_ids = set(
+			ConversationMembers.objects.filter(
+				conversation_id= conversation_id
+				).values_list("user_id", flat= True)
+		)
+		members.fill(user_ids)
+
+	return user_ids
+
+
+def user_group(user_id) -> str:
+	""" Group every live connection of a user is subscribed to. """
+
+	return f"user.{user_id}"
+
+
+def update_member_subscriptions(user_id, subscribe= (), unsubscribe= ()):
+	"""
+	Tells the live connections of a user about their membership changes, so that they
+	join the groups of the conversations they were added to and leave the others.
+	Routed by user, connections don't join conversation groups and there is nothing to do.
+	"""
+
+	if settings.CONVERSATION_ROUTING == "user":
+		return
 
-	group_name= str(conversation_id)
-	
 	async_to_sync(get_channel_layer().group_send)(
-		group_name, 
-		{"type": "send.message", "message": event}
-)
+		user_group(user_id),
+		{
+			"type": "update.subscriptions",
+			"subscribe": [str(conversation_id) for conversation_id in subscribe],
+			"unsubscribe": [str(conversation_id) for conversation_id in unsubscribe],
+		}
+	)
+
+
+def encode_event(event) -> str:
+	""" Websocket text frame of an event, see `ConversationConsumer.send_message`. """
+
+	return json.dumps({"message": event}, cls= DjangoJSONEncoder)
+
+
+def broadcast_conversation_event(conversation_id, event, replayable= True):
+	"""
+	Broadcast events from the application to the channels: to the group of the
+	conversation or, with CONVERSATION_ROUTING set to "user", to the groups of its members.
+
+	'event' should contain only type and message key.
+	Replayable events are written to the outbox, in the transaction of the caller, and
+	sent by `dispatch_outbox` once it commits. Others (typing and the like) are sent
+	right away, as every event is with CONVERSATION_EVENTS_OUTBOX off.
+	"""
+
+	if replayable and settings.CONVERSATION_EVENTS_OUTBOX:
+		OutboxEvent.objects.create(conversation_id= conversation_id, event= event)
+		transaction.on_commit(wake_outbox_dispatcher)
+		return
+
+	groups, message= prepare_conversation_event(conversation_id, event, replayable)
+	async_to_sync(group_send_many)(get_channel_layer(), groups, message)
+
+
+def prepare_conversation_event(conversation_id, event, replayable= True):
+	"""
+	Encodes an event into its websocket text frame, once for every recipient, and
+	returns the groups it goes to with the channel layer message. Unless not
+	`replayable`, the frame gets the next sequence number of the conversation and is
+	kept for the clients resuming their session.
+	"""
+
+	text= encode_event(event)
+	if replayable:
+		text= ConversationEventStream(conversation_id).append(text)
+
+	# Events not worth replaying aren't worth keeping slow clients behind either.
+	message= {"type": "send.message", "text": text, "droppable": not replayable}
+
+	return conversation_groups(conversation_id), message
+
+
+def wake_outbox_dispatcher():
+	""" Lets `dispatch_outbox` know events were committed, a single wakeup is kept pending. """
+
+	pipeline= get_redis_client().pipeline()
+	pipeline.lpush(OUTBOX_WAKEUP_KEY, 1)
+	pipeline.ltrim(OUTBOX_WAKEUP_KEY, 0, 0)
+	pipeline.execute()
+
+
+def conversation_groups(conversation_id) -> list:
+	""" Groups the events of a conversation are sent to, see CONVERSATION_ROUTING. """
+
+	if settings.CONVERSATION_ROUTING == "user":
+		return [user_group(user_id) for user_id in get_conversation_members(conversation_id)]
+
+	return [str(conversation_id)]
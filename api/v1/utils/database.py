@@ -0,0 +1,99 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from channels.db import database_sync_to_async
+from rest_framework.exceptions import APIException
+
+from api.metrics import metrics
+
+
+class DatabaseUnavailable(APIException):
+	status_code = 503
+	default_detail = "Server busy, try again later."
+	default_code = "database_unavailable"
+
+
+class DatabaseExecutor:
+	"""
+	Bounded pool of threads running the database work of consumers, each thread keeping
+	its own connection. Calls beyond `workers` running and `queue_size` waiting are
+	turned down rather than queued, and callers stop waiting after `timeout` seconds.
+	"""
+
+	def __init__(self, workers, queue_size, timeout):
+		self.workers = workers
+		self.queue_size = queue_size
+		self.timeout = timeout
+		self.executor = ThreadPoolExecutor(max_workers= workers, thread_name_prefix= "consumer-db")
+		self.lock = threading.Lock()
+		self.pending = 0
+
+	async def run(self, func, *args, **kwargs):
+		with self.lock:
+			if self.pending >= self.workers + self.queue_size:
+				metrics.incr("consumer_db.rejected")
+				raise DatabaseUnavailable()
+
+			self.pending += 1
+			metrics.gauge("consumer_db.pending", self.pending)
+
+		future = self.executor.submit(
+			contextvars.copy_context().run, self.call, func, time.monotonic(), args, kwargs)
+		# Done once the call is over, or cancelled before it started.
+		future.add_done_callback(self.release)
+
+		try:
+			return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+		except asyncio.TimeoutError:
+			# A call already running goes on in its thread, and counts as pending until it is over.
+			metrics.incr("consumer_db.timeouts")
+			raise DatabaseUnavailable("Database call timed out.")
+
+	def call(self, func, queued_at, args, kwargs):
+		metrics.observe("consumer_db.wait_ms", (time.monotonic() - queued_at) * 1000)
+
+		close_old_connections()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			close_old_connections()
+
+	def release(self, future):
+		with self.lock:
+			self.pending -= 1
+			metrics.gauge("consumer_db.pending", self.pending)
+
+
+@lru_cache(maxsize= None)
+def get_database_executor(workers, queue_size, timeout) -> DatabaseExecutor:
+	return DatabaseExecutor(workers, queue_size, timeout)
+
+
+def database_task(func):
+	"""
+	Same as `database_sync_to_async`, running `func` on the database executor of the
+	consumers instead of the single thread shared by the whole process.
+	With CONSUMER_DB_WORKERS set to 0, falls back to `database_sync_to_async`.
+	"""
+
+	fallback = database_sync_to_async(func)
+
+	@functools.wraps(func)
+	async def wrapper(*args, **kwargs):
+		if not settings.CONSUMER_DB_WORKERS:
+			return await fallback(*args, **kwargs)
+
+		executor = get_database_executor(
+			settings.CONSUMER_DB_WORKERS, settings.CONSUMER_DB_QUEUE_SIZE, settings.CONSUMER_DB_TIMEOUT)
+
+		return await executor.run(func, *args, **kwargs)
+
+	return wrapper
@@ -0,0 +1,85 @@
+import json
+import zlib
+from functools import lru_cache
+
+import msgpack
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+# Websocket subprotocols a client can ask for, JSON text frames being the default.
+# The ".deflate" variants are sent as binary frames compressed with raw deflate, the
+# ASGI servers we run on don't negotiate permessage-deflate.
+SUBPROTOCOLS = ("json", "json.deflate", "msgpack", "msgpack.deflate")
+
+
+def choose_subprotocol(offered) -> str | None:
+	""" First subprotocol offered by the client that we speak, None for plain JSON. """
+
+	return next((protocol for protocol in offered if protocol in SUBPROTOCOLS), None)
+
+
+def encode_frame(frame: dict, protocol= None) -> dict:
+	""" Encodes a frame for `protocol`, as the keyword arguments of `WebsocketConsumer.send`. """
+
+	return convert_text_frame(json.dumps(frame, cls= DjangoJSONEncoder), protocol)
+
+
+@lru_cache(maxsize= 256)
+def encode_text_frame(text: str, protocol= None) -> dict:
+	"""
+	Same as `encode_frame` for a broadcast frame, which reaches every socket of the
+	process already encoded as JSON: it is converted once per protocol.
+	"""
+
+	return convert_text_frame(text, protocol)
+
+
+def convert_text_frame(text: str, protocol= None) -> dict:
+	if protocol in [None, "json"]:
+		return {"text_data": text}
+
+	if protocol.startswith("msgpack"):
+		data = msgpack.packb(json.loads(text))
+	else:
+		data = text.encode()
+
+	if protocol.endswith(".deflate"):
+		data = deflate(data)
+
+	return {"bytes_data": data}
+
+
+def decode_frame(text_data= None, bytes_data= None, protocol= None):
+	""" Decodes a frame received from a client speaking `protocol`, raises ValueError when malformed. """
+
+	if text_data is not None:
+		return json.loads(text_data)
+
+	if protocol and protocol.endswith(".deflate"):
+		bytes_data = inflate(bytes_data, settings.WEBSOCKET_MAX_FRAME_SIZE)
+
+	if protocol and protocol.startswith("msgpack"):
+		return msgpack.unpackb(bytes_data)
+
+	return json.loads(bytes_data)
+
+
+def deflate(data: bytes) -> bytes:
+	compressor = zlib.compressobj(wbits= -zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+
+def inflate(data: bytes, max_length: int) -> bytes:
+	""" Decompresses raw deflate, raises ValueError past `max_length` bytes rather than inflating a bomb. """
+
+	decompressor = zlib.decompressobj(wbits= -zlib.MAX_WBITS)
+	try:
+		inflated = decompressor.decompress(data, max_length)
+	except zlib.error as error:
+		raise ValueError(error)
+
+	if decompressor.unconsumed_tail:
+		raise ValueError(f"Frame larger than {max_length} bytes.")
+
+	return inflated
@@ -0,0 +1,51 @@
+import asyncio
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+from api.models import OutboxEvent
+from api.metrics import metrics
+from api.v1.utils.channels import group_send_many
+from api.v1.utils.conversation import prepare_conversation_event
+
+
+def dispatch_outbox(batch_size= 100) -> int:
+	"""
+	Sends the oldest committed events of the outbox and deletes them, returns how many
+	were sent. Rows are locked for the batch so that dispatchers running side by side
+	take turns rather than reordering events. Delivery is at least once: a batch that
+	fails halfway is sent again.
+	"""
+
+	with transaction.atomic():
+		events= list(OutboxEvent.objects.select_for_update().order_by("id")[:batch_size])
+		if not events:
+			return 0
+
+		sends= defaultdict(list)
+		for event in events:
+			sends[event.conversation_id].append(prepare_conversation_event(event.conversation_id, event.event))
+
+		async_to_sync(send_in_order)(get_channel_layer(), list(sends.values()))
+
+		OutboxEvent.objects.filter(id__in= [event.id for event in events]).delete()
+
+	now= timezone.now()
+	for event in events:
+		metrics.observe("outbox.lag_ms", (now - event.created_at).total_seconds() * 1000)
+
+	return len(events)
+
+
+async def send_in_order(channel_layer, sends):
+	""" Sends the (groups, message) of every conversation one after the other, conversations concurrently. """
+
+	async def send(messages):
+		for groups, message in messages:
+			await group_send_many(channel_layer, groups, message)
+
+	await asyncio.gather(*(send(messages) for messages in sends))
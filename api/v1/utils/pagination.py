@@ -1,4 +1,11 @@
-from rest_framework.pagination import LimitOffsetPagination
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from api.cache import CachedMessage, parse_message_key
 
 class CustomLimitOffsetPagination(LimitOffsetPagination):
 	"""
@@ -23,3 +30,99 @@ class CustomLimitOffsetPagination(LimitOffsetPagination):
 		
 		return queryset
 
+
+class MessageCursorPagination(CustomLimitOffsetPagination):
+	"""
+	Keyset pagination for messages, newest first, for requests passing `before` or
+	`after`: they take the cursor of a message, built from its (sent_at, id), so every
+	page costs the same and pages don't shift when new messages arrive. An empty
+	`before` starts from the newest message. Other requests keep being served by the
+	limit/offset logic, with its `count` and links.
+	"""
+
+	before_query_param = "before"
+	after_query_param = "after"
+	invalid_cursor_message = "Invalid cursor"
+
+	def is_cursor_request(self, request):
+		params = request.query_params
+		return self.before_query_param in params or self.after_query_param in params
+
+	def encode_cursor(self, message: CachedMessage):
+		return urlsafe_b64encode(message.key.encode()).decode()
+
+	def decode_cursor(self, request, param):
+		cursor = request.query_params.get(param)
+		if not cursor:
+			return None
+
+		try:
+			key = urlsafe_b64decode(cursor.encode()).decode()
+			parse_message_key(key)
+		except (TypeError, ValueError):
+			raise NotFound(self.invalid_cursor_message)
+
+		return key
+
+	def get_cursors(self, request):
+		""" Returns the (before, after) message keys requested. """
+
+		return (
+			self.decode_cursor(request, self.before_query_param),
+			self.decode_cursor(request, self.after_query_param)
+		)
+
+	def paginate_queryset(self, queryset, request, view=None):
+		if not self.is_cursor_request(request):
+			self.cursor_mode = False
+			return super().paginate_queryset(queryset, request, view)
+
+		self.cursor_mode = True
+		self.request = request
+		self.limit = self.get_limit(request)
+		before, after = self.get_cursors(request)
+
+		messages = list(queryset)
+		has_more = len(messages) > self.limit
+		messages = messages[-self.limit:] if after else messages[:self.limit]
+
+		self.next_cursor = self.previous_cursor = None
+
+		if messages and (has_more or after):
+			self.next_cursor = self.encode_cursor(messages[-1])
+
+		if messages and (has_more if after else before):
+			self.previous_cursor = self.encode_cursor(messages[0])
+
+		return messages
+
+	def get_cursor_link(self, param, cursor):
+		if cursor is None:
+			return None
+
+		url = self.request.build_absolute_uri()
+		url = remove_query_param(url, self.before_query_param)
+		url = remove_query_param(url, self.after_query_param)
+		return replace_query_param(url, param, cursor)
+
+	def get_paginated_response(self, data):
+		if not self.cursor_mode:
+			return super().get_paginated_response(data)
+
+		return Response({
+			"next": self.get_cursor_link(self.before_query_param, self.next_cursor),
+			"previous": self.get_cursor_link(self.after_query_param, self.previous_cursor),
+			"results": data,
+		})
+
+
+class InboxCursorPagination(CursorPagination):
+	"""
+	Keyset pagination of the inbox, most recently active conversation first. It runs
+	over the memberships of the user, and cursors hold the `last_message_at` a page
+	ended on, so that every page is a range scan of `member_inbox_idx` however deep.
+	"""
+
+	ordering = ("-last_message_at", "-conversation_id")
+	page_size_query_param = "limit"
+	max_page_size = 100
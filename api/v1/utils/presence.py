@@ -0,0 +1,89 @@
+from django.conf import settings
+
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+from api.models import ConversationMembers
+from api.cache import UserPresence
+from api.metrics import metrics
+from api.v1.utils.channels import group_send_many
+from api.v1.utils.conversation import get_conversation_members, conversation_groups, encode_event
+from api.v1.utils.scheduler import scheduler
+
+
+def update_presence(user_id, channel_name, connected: bool):
+	"""
+	Records a websocket connection of the user opening (or sending a heartbeat) or
+	closing, and broadcasts the user's presence when it changed.
+	"""
+
+	presence = UserPresence(user_id)
+
+	if connected:
+		scheduler.call_every(settings.PRESENCE_SWEEP_INTERVAL, sweep_presence)
+		changed = presence.connect(channel_name, settings.PRESENCE_TIMEOUT)
+	else:
+		changed = presence.disconnect(channel_name)
+
+	if changed:
+		broadcast_presence(user_id)
+
+
+def broadcast_presence(user_id):
+	"""
+	Lets the conversations of the user know whether they are online. Changes are
+	debounced over PRESENCE_DEBOUNCE: the first one opens the window and the state of
+	the user when it closes is broadcast, if it differs from the last one broadcast,
+	so that flapping connections don't reach the rooms.
+	"""
+
+	window = settings.PRESENCE_DEBOUNCE
+
+	if not UserPresence(user_id).debounce(window):
+		return
+
+	if not window:
+		return flush_presence(user_id)
+
+	scheduler.call_later(window, flush_presence, user_id)
+
+
+def flush_presence(user_id):
+	presence = UserPresence(user_id)
+	online = UserPresence.online([user_id])[user_id]
+
+	if not presence.mark_broadcast(online):
+		return metrics.incr("presence.debounced")
+
+	conversation_ids = ConversationMembers.objects.filter(
+		user_id= user_id).values_list("conversation_id", flat= True)
+
+	groups = set()
+	for conversation_id in conversation_ids:
+		groups.update(conversation_groups(conversation_id))
+
+	message = {
+		"type": "send.message",
+		"text": encode_event({"type": "user.presence", "message": {"user": user_id, "online": online}}),
+		"droppable": True,
+	}
+
+	async_to_sync(group_send_many)(get_channel_layer(), groups, message)
+	metrics.incr("presence.broadcasts")
+
+
+def sweep_presence():
+	"""
+	Broadcasts the users whose connections all lapsed without closing (crashed workers,
+	dropped networks) as offline, which no disconnect ever did.
+	"""
+
+	for user_id in UserPresence.sweep(settings.PRESENCE_SWEEP_BATCH):
+		metrics.incr("presence.swept")
+		broadcast_presence(user_id)
+
+
+def get_presence(conversation_id) -> dict:
+	""" Whether each member of a conversation is online, by user id. """
+
+	return UserPresence.online(sorted(get_conversation_members(conversation_id)))
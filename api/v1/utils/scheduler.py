@@ -0,0 +1,111 @@
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from django.db import close_old_connections
+
+from api.metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class FlushScheduler:
+	"""
+	Runs the flushes of coalescing windows (read receipts, typing, presence) once they
+	are due, from a single thread per process working through a heap of due times,
+	rather than a thread per window. Flushes still pending when the process exits are
+	run right away, so that the windows it opened are not left unflushed.
+	"""
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.counter = itertools.count()
+		self.queue = []
+		self.thread = None
+		self.periodic = set()
+
+	def call_every(self, interval: float, func):
+		""" Calls `func()` every `interval` seconds, once however many times it is registered. """
+
+		with self.condition:
+			if func in self.periodic:
+				return
+			self.periodic.add(func)
+
+		self.push(interval, self.repeat, (interval, func))
+
+	def repeat(self, interval, func):
+		try:
+			func()
+		finally:
+			self.push(interval, self.repeat, (interval, func))
+
+	def call_later(self, delay: float, func, *args):
+		self.push(delay, func, args)
+
+	def push(self, delay, func, args):
+		with self.condition:
+			heapq.heappush(self.queue, (time.monotonic() + delay, next(self.counter), func, args))
+			metrics.gauge("scheduler.pending", len(self.queue))
+
+			if self.thread is None:
+				self.thread = threading.Thread(target= self.run, name= "flush-scheduler", daemon= True)
+				self.thread.start()
+
+			self.condition.notify()
+
+	def run(self):
+		while True:
+			with self.condition:
+				while not self.queue or self.queue[0][0] > time.monotonic():
+					self.condition.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+
+				_, _, func, args = heapq.heappop(self.queue)
+				metrics.gauge("scheduler.pending", len(self.queue))
+
+			self.call(func, args)
+
+	def call(self, func, args):
+		try:
+			func(*args)
+		except Exception:
+			logger.exception("Scheduled flush %s failed", getattr(func, "__name__", func))
+		finally:
+			close_old_connections()
+
+	def run_pending(self):
+		""" Runs every pending flush now, in the order they were due. """
+
+		with self.condition:
+			pending, self.queue = sorted(self.queue), []
+
+		for _, _, func, args in pending:
+			self.call(func, args)
+
+	def cancel_pending(self):
+		""" Drops every pending flush. """
+
+		with self.condition:
+			metrics.gauge("scheduler.pending", 0)
+			self.queue = []
+			self.periodic = set()
+
+	def reset(self):
+		# The thread of the parent is not carried over by fork, nor are its flushes.
+		self.condition = threading.Condition()
+		self.queue = []
+		self.thread = None
+		self.periodic = set()
+
+
+scheduler = FlushScheduler()
+
+atexit.register(scheduler.run_pending)
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child= scheduler.reset)
+
@@ -0,0 +1,23 @@
+from types import SimpleNamespace
+
+from rest_framework.exceptions import Throttled
+from rest_framework.throttling import ScopedRateThrottle, SimpleRateThrottle
+
+
+class UserScopedRateThrottle(ScopedRateThrottle):
+	"""
+	ScopedRateThrottle for work done outside of views, such as websocket frames. It
+	keeps the history of the user under the same cache key as the views of `scope`, so
+	that requests count against one rate whichever way they come in.
+	"""
+
+	def __init__(self, scope):
+		self.scope = scope
+		self.rate = self.get_rate()
+		self.num_requests, self.duration = self.parse_rate(self.rate)
+
+	def check(self, user):
+		""" Records a request of the user, raises Throttled past the rate of the scope. """
+
+		if not SimpleRateThrottle.allow_request(self, SimpleNamespace(user= user), None):
+			raise Throttled(self.wait())
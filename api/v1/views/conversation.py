@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 
@@ -11,16 +12,17 @@ from rest_framework.request import Request
 from rest_framework.filters import SearchFilter
 
 from api.models import Conversation,  ConversationMembers, Message
-from api.v1.utils import CustomLimitOffsetPagination
+from api.v1.utils import (
+	MessageCursorPagination, InboxCursorPagination, render_cached_messages, get_presence)
 from api.v1.signals import new_conversation_event
 from api.v1.permissions import (
 	IsConversationMember, IsConversationAdmin, IsMessageOwnerorAdmin)
 
 from api.v1.serializers.conversation import (
 	CreateConversationSerializer, ConversationSerializer,
-	SimpleConversationSerializer, AddORemoveMemberConversationSerializer,
+	SimpleConversationSerializer, InboxConversationSerializer, AddORemoveMemberConversationSerializer,
 	CreateMessageSerializer, UpdateMessageSerializer, MessageSerializer,
-	SimpleMessageSerializer, MarkMessageReadSerializer
+	SimpleMessageSerializer, MarkMessageReadSerializer, ReadMessagesSerializer
 )
 
 class ConversationViewSet(ModelViewSet):
@@ -41,6 +43,11 @@ class ConversationViewSet(ModelViewSet):
 		if self.action == "mark_message_read":
 			return MarkMessageReadSerializer
 		
+		if self.action == "read":
+			return ReadMessagesSerializer
+
+		if self.action == "inbox":
+			return InboxConversationSerializer
 
 		return SimpleConversationSerializer
 	
@@ -48,7 +55,7 @@ class ConversationViewSet(ModelViewSet):
 		if self.action in ["add_member", "remove_member", "make_admin"]:
 			return [IsAuthenticated(), IsConversationMember(), IsConversationAdmin()]
 		
-		if self.action == "mark_message_read":
+		if self.action in ["mark_message_read", "read", "presence"]:
 			return [IsAuthenticated(), IsConversationMember()]
 
 		return [IsAuthenticated()]
@@ -57,6 +64,9 @@ class ConversationViewSet(ModelViewSet):
 		if self.action == "list":
 			return Conversation.objects.filter(members= self.request.user)
 
+		if self.action == "inbox":
+			return ConversationMembers.objects.filter(user= self.request.user).select_related("conversation")
+
 		return Conversation.objects.filter(
 			Q(is_private= False) | 
 			Q(is_private=True, members= self.request.user)
@@ -72,6 +82,7 @@ class ConversationViewSet(ModelViewSet):
 	
 
 	@action(detail=True, methods=["post"])
+	@transaction.atomic
 	def join(self, request: Request, **kwargs):
 		conversation = self.get_object()
 
@@ -101,6 +112,7 @@ class ConversationViewSet(ModelViewSet):
 		return Response(status= status.HTTP_204_NO_CONTENT)
 
 	@action(detail=True, methods=["post"])
+	@transaction.atomic
 	def add_member(self, request: Request, **kwargs):
 		conversation = self.get_object()
 		serializer = self.get_serializer(data= request.data)
@@ -117,6 +129,8 @@ class ConversationViewSet(ModelViewSet):
 		admin_first_name= request.user.first_name
 		user_first_name= user.first_name
 
+		conversation.members.add(user)
+
 		new_conversation_event.send_robust(
 			sender= None, 
 			conversation_id= conversation.id,
@@ -124,12 +138,11 @@ class ConversationViewSet(ModelViewSet):
 				"type": "user.added", 
 				"message": f"{admin_first_name} added {user_first_name} to the conversation."
 			})
-			
-		conversation.members.add(user)
 
 		return Response(status= status.HTTP_204_NO_CONTENT)
 	
 	@action(detail=True, methods=["post"])
+	@transaction.atomic
 	def remove_member(self, request: Request, **kwargs):
 		conversation = self.get_object()
 		serializer = self.get_serializer(data= request.data)
@@ -166,6 +179,7 @@ class ConversationViewSet(ModelViewSet):
 		return Response(status= status.HTTP_204_NO_CONTENT)
 	
 	@action(detail=True, methods=["post"])
+	@transaction.atomic
 	def leave_conversation(self, request: Request, **kwargs):
 		conversation = self.get_object()
 
@@ -228,21 +242,58 @@ class ConversationViewSet(ModelViewSet):
 
 		return Response(status= status.HTTP_204_NO_CONTENT)
 	
+	@action(detail=True, methods=["post"])
+	def read(self,  request: Request, **kwargs):
+		conversation = self.get_object()
+		serializer = self.get_serializer(
+			data= request.data, 
+			context= {"user": request.user, "conversation": conversation}
+		)
+		serializer.is_valid(raise_exception= True)
+		serializer.save()
+
+		return Response(status= status.HTTP_204_NO_CONTENT)
+
+	@action(detail=False, methods=["get"])
+	def inbox(self, request: Request, **kwargs):
+		"""
+		Conversations of the user, most recently active first, each with its last message,
+		in a single query paginated by `InboxCursorPagination`.
+		"""
+
+		paginator = InboxCursorPagination()
+		page = paginator.paginate_queryset(self.get_queryset(), request, view= self)
+		serializer = self.get_serializer(page, many= True)
+
+		return paginator.get_paginated_response(serializer.data)
+
+	@action(detail=True, methods=["get"])
+	def presence(self,  request: Request, **kwargs):
+		conversation = self.get_object()
+
+		return Response(data= get_presence(conversation.id))
+
 	@action(detail=True, methods=["post"])
 	def mark_message_read(self,  request: Request, **kwargs):
+		conversation = self.get_object()
 		serializer = self.get_serializer(
 			data= request.data.get("data"), 
-			context= {"user": self.request.user},
 			many= True
 		)
 		serializer.is_valid(raise_exception= True)
+
+		serializer = ReadMessagesSerializer(
+			data= {"messages": [item["message"] for item in serializer.validated_data]},
+			context= {"user": request.user, "conversation": conversation}
+		)
+		serializer.is_valid(raise_exception= True)
 		serializer.save()
 
 		return Response(status= status.HTTP_204_NO_CONTENT)
 	
 
 class MessageViewSet(ModelViewSet):
-	pagination_class = CustomLimitOffsetPagination
+	pagination_class = MessageCursorPagination
 	throttle_scope = 'messages'
 	
 	def get_serializer_class(self):
@@ -268,15 +319,20 @@ class MessageViewSet(ModelViewSet):
 
 	def get_queryset(self):
 		if self.action == "list":
-			limit= int(self.request.query_params.get("limit", 50))
-			offset= int(self.request.query_params.get("offset", 0))
+			paginator: MessageCursorPagination= self.paginator
+			limit= paginator.get_limit(self.request)
 			conversation_id= self.kwargs.get("conversation_pk")
 
+			if paginator.is_cursor_request(self.request):
+				before, after= paginator.get_cursors(self.request)
+				return Message.objects.get_page(conversation_id, limit, before= before, after= after)
+
+			offset= paginator.get_offset(self.request)
 			return Message.objects.get_messages(conversation_id, offset, limit)
 		
 		return Message.objects.filter(
 			conversation_id= self.kwargs.get("conversation_pk"), 
-		)
+		).select_related("sent_by")
 	
 	def get_serializer_context(self):
 		context=  {
@@ -292,12 +348,23 @@ class MessageViewSet(ModelViewSet):
 	
 	def get_object(self) -> Message:
 		return super().get_object()
+
+	def list(self, request: Request, *args, **kwargs):
+		""" Pages are cached records already in their serialized form, only reader fields are added. """
+
+		page= self.paginate_queryset(self.get_queryset())
+		return self.get_paginated_response(render_cached_messages(page, request.user))
 	
+	@transaction.atomic
+	def create(self, request, *args, **kwargs):
+		return super().create(request, *args, **kwargs)
+
 	def perform_update(self, serializer: ModelSerializer):		
 		serializer.validated_data["updated_at"]= timezone.now()
 
 		return super().perform_update(serializer)
 	
+	@transaction.atomic
 	def update(self, request, *args, **kwargs):
 		message= self.get_object()
 
@@ -309,6 +376,7 @@ class MessageViewSet(ModelViewSet):
 		
 		return super().update(request, *args, **kwargs)
 	
+	@transaction.atomic
 	def destroy(self, request, *args, **kwargs):
 		message= self.get_object()
 
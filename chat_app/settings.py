@@ -55,6 +55,82 @@ CHANNEL_LAYERS = {
 
 CACHES = {'default': env.cache("REDIS_CACHE_URL")}
 
+REDIS_CACHE_URL = env.str("REDIS_CACHE_URL")
+
+# Number of most recent messages kept in the per-conversation Redis window.
+MESSAGE_CACHE_SIZE = env.int("MESSAGE_CACHE_SIZE", default=500)
+
+# Size of the optional in-process cache kept in front of the Redis message windows
+# by every worker (bytes, 0 disables it).
+MESSAGE_CACHE_LOCAL_MAX_BYTES = env.int("MESSAGE_CACHE_LOCAL_MAX_BYTES", default=0)
+
+# How long a cold message window may take to rebuild (seconds). Other requests read
+# the database meanwhile.
+MESSAGE_CACHE_REBUILD_TIMEOUT = env.float("MESSAGE_CACHE_REBUILD_TIMEOUT", default=5.0)
+
+# Seconds between flushes of the process-local metrics to Redis.
+METRICS_FLUSH_INTERVAL = env.float("METRICS_FLUSH_INTERVAL", default=1.0)
+
+# Seconds the gauges of a worker are kept after its last flush, so that those of
+# workers which are gone stop counting.
+METRICS_GAUGE_TTL = env.int("METRICS_GAUGE_TTL", default=60)
+
+# Read receipts of a conversation are broadcast together at most once per window
+# (seconds, 0 broadcasts every one of them right away).
+READ_RECEIPT_COALESCE_WINDOW = env.float("READ_RECEIPT_COALESCE_WINDOW", default=0.5)
+
+# How conversation events reach websockets: "conversation" has every connection join
+# one channel layer group per conversation, "user" has it join a single group of its
+# user and events fanned out to the groups of the conversation members.
+CONVERSATION_ROUTING = env.str("CONVERSATION_ROUTING", default="conversation")
+
+# Conversation events are written to an outbox table and broadcast by the
+# dispatch_outbox command once committed. Off, they are broadcast by the request.
+CONVERSATION_EVENTS_OUTBOX = env.bool("CONVERSATION_EVENTS_OUTBOX", default=True)
+
+# Number of events of every conversation kept for the websocket clients resuming their
+# session, those further behind reload the conversation instead.
+EVENT_STREAM_LENGTH = env.int("EVENT_STREAM_LENGTH", default=1000)
+
+# Seconds a websocket connection counts as online without a heartbeat, and window over
+# which the presence changes of a user are debounced before being broadcast.
+PRESENCE_TIMEOUT = env.int("PRESENCE_TIMEOUT", default=60)
+PRESENCE_DEBOUNCE = env.float("PRESENCE_DEBOUNCE", default=5.0)
+
+# Seconds between sweeps of the connections which lapsed without closing (crashed
+# workers, dropped networks), whose users are then broadcast offline, and how many
+# users a sweep handles at most.
+PRESENCE_SWEEP_INTERVAL = env.float("PRESENCE_SWEEP_INTERVAL", default=15.0)
+PRESENCE_SWEEP_BATCH = env.int("PRESENCE_SWEEP_BATCH", default=1000)
+
+# Users count as typing for TYPING_TIMEOUT seconds after their last typing frame. The
+# users typing in a conversation are broadcast at most once per interval (seconds),
+# listing the first TYPING_MAX_USERS of them.
+TYPING_TIMEOUT = env.float("TYPING_TIMEOUT", default=6.0)
+TYPING_BROADCAST_INTERVAL = env.float("TYPING_BROADCAST_INTERVAL", default=1.0)
+TYPING_MAX_USERS = env.int("TYPING_MAX_USERS", default=5)
+
+# Frames waiting to be written to a websocket. Clients falling further behind are
+# disconnected and resume their session.
+WEBSOCKET_SEND_QUEUE_SIZE = env.int("WEBSOCKET_SEND_QUEUE_SIZE", default=256)
+
+# Largest frame accepted from a client once decompressed (bytes), compressed frames
+# inflating past it are rejected.
+WEBSOCKET_MAX_FRAME_SIZE = env.int("WEBSOCKET_MAX_FRAME_SIZE", default=1048576)
+
+# Users resolved from access tokens are cached in Redis and by every process (seconds,
+# 0 disables either). Changes to a user reach other processes after the local timeout.
+AUTH_USER_CACHE_TIMEOUT = env.int("AUTH_USER_CACHE_TIMEOUT", default=300)
+AUTH_USER_LOCAL_TIMEOUT = env.float("AUTH_USER_LOCAL_TIMEOUT", default=5.0)
+AUTH_USER_LOCAL_MAX_ENTRIES = env.int("AUTH_USER_LOCAL_MAX_ENTRIES", default=10000)
+
+# Threads (and so database connections) running the database work of the websocket
+# consumers of every process, calls allowed to wait for one, and seconds before a call
+# is given up on. 0 workers runs it on the single thread of `database_sync_to_async`.
+CONSUMER_DB_WORKERS = env.int("CONSUMER_DB_WORKERS", default=8)
+CONSUMER_DB_QUEUE_SIZE = env.int("CONSUMER_DB_QUEUE_SIZE", default=64)
+CONSUMER_DB_TIMEOUT = env.float("CONSUMER_DB_TIMEOUT", default=10.0)
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -168,7 +244,7 @@ REST_FRAMEWORK = {
     "DEFAULT_RENDERER_CLASSES": ("rest_framework.renderers.JSONRenderer",),
     "DEFAULT_PERMISSION_CLASSES": ["rest_framework.permissions.IsAuthenticated"],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.utils.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_THROTTLE_CLASSES': [
         'rest_framework.throttling.ScopedRateThrottle',